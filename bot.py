@@ -1,13 +1,28 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import time
+
+_T_IMPORT_START = time.perf_counter()  # start-up measurement begins before the heavy imports
+
 import os
+import asyncio
+import collections
+import csv
+import functools
+import json
 import logging
 import re
 import io
+import math
+import signal
+import sqlite3
+import sys
+import threading
 import zoneinfo
 from datetime import datetime, timedelta
-from telegram.error import BadRequest, RetryAfter, TimedOut
+from typing import Callable, NamedTuple, Optional
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -19,6 +34,8 @@ from telegram import (
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
+    PicklePersistence,
+    TypeHandler,
     MessageHandler,
     ContextTypes,
     ConversationHandler,
@@ -26,22 +43,96 @@ from telegram.ext import (
     CallbackQueryHandler,
 )
 
-# === Support multiple PTB installations for Request ===
-try:
-    from telegram.request import Request
-except Exception:
-    try:
-        from telegram.utils.request import Request
-    except Exception:
-        Request = None  # we'll handle None in main()
+# === HTTP backend (ApplicationBuilder is PTB v20+, which always ships HTTPXRequest) ===
+from telegram.request import HTTPXRequest
 
 # ===== CONFIG =====
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8367165107:AAFmfC0gKHZiBjbO_-SDPCOtroypIy3fUKc")
 TARGET_CHAT_ID = int(os.environ.get("TARGET_CHAT_ID", "-1003166932796"))
-IMAGE_PATH = "image.jpg"  # optional
+IMAGE_PATH = "image.jpg"  # optional, read lazily on first use
 PRICE_PER_BOTTLE = 20000
 CURRENCY = "UZS"
 
+# persistent data (customer store, conversation state, update offset, profiles) lives in
+# DATA_DIR; the Docker image sets it to the /data volume so it survives redeploys
+DATA_DIR = os.environ.get("DATA_DIR", ".")
+
+# customer/order store (sqlite) and admins allowed to run /broadcast
+DB_PATH = os.environ.get("DB_PATH", os.path.join(DATA_DIR, "orders.db"))
+ADMIN_IDS = [int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()]
+
+# broadcast tuning: Telegram allows ~30 messages/second across different chats
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "6"))  # keep below HTTP_POOL_SIZE
+BROADCAST_PAGE_SIZE = int(os.environ.get("BROADCAST_PAGE_SIZE", "200"))
+BROADCAST_PROGRESS_INTERVAL = 5.0  # seconds between progress message edits
+
+# order routing table (JSON): district/province -> operations chats, see routes.example.json.
+# ORDER_ROUTES may hold the JSON itself; otherwise ORDER_ROUTES_PATH is read if it exists.
+ORDER_ROUTES = os.environ.get("ORDER_ROUTES", "")
+ORDER_ROUTES_PATH = os.environ.get("ORDER_ROUTES_PATH", "routes.json")
+
+# order digest: "off" sends each order at once, "text" / "csv" batch orders per target chat
+ORDER_DIGEST_MODE = os.environ.get("ORDER_DIGEST_MODE", "off").lower()
+ORDER_DIGEST_WINDOW = float(os.environ.get("ORDER_DIGEST_WINDOW", "300"))  # seconds
+ORDER_DIGEST_MAX = int(os.environ.get("ORDER_DIGEST_MAX", "20"))  # orders per batch
+# urgent orders skip the digest: big quantity, or delivery within N days (the earliest
+# date offered is tomorrow, so 1 = next-day orders; 0 disables the date rule)
+URGENT_QUANTITY = int(os.environ.get("URGENT_QUANTITY", "50"))
+URGENT_DELIVERY_DAYS = int(os.environ.get("URGENT_DELIVERY_DAYS", "1"))
+TELEGRAM_MAX_MESSAGE = 4096
+TELEGRAM_MAX_CAPTION = 1024
+
+# graceful shutdown: conversation state is persisted here, the last processed update
+# offset is saved to OFFSET_PATH, and SIGTERM drains work for at most SHUTDOWN_TIMEOUT seconds.
+# Keep it below the orchestrator's grace period (docker stop waits 10 s, raise it with -t /
+# stop_grace_period) - the offset is saved before the drain, pending sends are lost on a kill.
+STATE_PATH = os.environ.get("STATE_PATH", os.path.join(DATA_DIR, "bot_state.pickle"))
+OFFSET_PATH = os.environ.get("OFFSET_PATH", os.path.join(DATA_DIR, "update_offset.json"))
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "8"))
+
+# start-up budget: with STARTUP_PROFILE=1 (or --measure-startup) import, build and ready latencies
+# are logged once polling is about to start, and again with the first handled update; both are
+# checked against STARTUP_BUDGET_MS. --measure-startup exits after the first update, or after
+# STARTUP_MEASURE_TIMEOUT seconds when none arrives (e.g. in CI)
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE", "") not in ("", "0") or "--measure-startup" in sys.argv
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", "1000"))
+STARTUP_MEASURE_TIMEOUT = float(os.environ.get("STARTUP_MEASURE_TIMEOUT", "5"))
+
+# health/readiness HTTP endpoint (HEALTH_PORT=0 disables it)
+HEALTH_HOST = os.environ.get("HEALTH_HOST", "0.0.0.0")
+HEALTH_PORT = int(os.environ.get("HEALTH_PORT", "8080"))
+HEALTH_STALL_SECONDS = float(os.environ.get("HEALTH_STALL_SECONDS", "90"))  # max age of last getUpdates
+HEALTH_MAX_LOOP_LAG = float(os.environ.get("HEALTH_MAX_LOOP_LAG", "5"))  # seconds
+CONVERSATION_ACTIVE_WINDOW = 30 * 60  # a conversation idle longer than this is not "active"
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "8"))
+
+# opt-in profiler: handler timing, slow-update and blocked-loop logs, periodic folded-stack
+# profile (flamegraph.pl / speedscope "collapsed" format) sampled at PROFILE_SAMPLE_HZ (<= 0 keeps
+# handler timing but turns stack sampling off)
+PROFILE = os.environ.get("PROFILE", "") not in ("", "0")
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "500"))
+PROFILE_SAMPLE_HZ = float(os.environ.get("PROFILE_SAMPLE_HZ", "10"))
+PROFILE_PATH = os.environ.get("PROFILE_PATH", os.path.join(DATA_DIR, "profile.folded"))
+PROFILE_EXPORT_INTERVAL = float(os.environ.get("PROFILE_EXPORT_INTERVAL", "60"))
+
+# delivery area: service bounding box "lat_min,lon_min,lat_max,lon_max", depot location, distance
+# zones with fees, and the street gazetteer used to normalize addresses. The defaults cover all of
+# Tashkent city and province (Bekabad in the south ~121 km, Bostanliq mountains ~170 km). A box
+# cannot follow the state border: towns just across it (Saryagash in Kazakhstan, Khujand in
+# Tajikistan) are accepted too, so narrow SERVICE_AREA if those orders must be refused.
+SERVICE_AREA = os.environ.get("SERVICE_AREA", "40.10,68.60,42.30,71.30")
+DEPOT_LAT = float(os.environ.get("DEPOT_LAT", "41.3111"))
+DEPOT_LON = float(os.environ.get("DEPOT_LON", "69.2797"))
+DELIVERY_ZONES = os.environ.get(
+    "DELIVERY_ZONES",
+    '[{"max_km": 10, "zone": "A", "fee": 0}, {"max_km": 20, "zone": "B", "fee": 10000},'
+    ' {"max_km": 40, "zone": "C", "fee": 20000}, {"max_km": 180, "zone": "D", "fee": 35000}]',
+)
+GEO_GRID_DEG = 0.005  # ~500 m cells for the per-location cache
+STREETS_PATH = os.environ.get("STREETS_PATH", "streets.txt")
+STREET_MATCH_MIN_SCORE = 0.6
+
 # timezone (use zoneinfo to ensure bot uses Asia/Tashkent consistently)
 TZ = zoneinfo.ZoneInfo("Asia/Tashkent")
 
@@ -51,7 +142,11 @@ logger = logging.getLogger(__name__)
 
 # ===== STATES =====
 # REGION bosqichi olib tashlandi.
-LANG, PERSON_TYPE, PHONE, NAME, QUANTITY, COMMENT, COMMENT_INPUT, CITY_OR_PROVINCE, DISTRICT, ADDRESS_TEXT, AWAIT_GEOLOCATION, DELIVERY_DATE, PAYMENT = range(13)
+STATE_NAMES = (
+    "LANG", "PERSON_TYPE", "PHONE", "NAME", "QUANTITY", "COMMENT", "COMMENT_INPUT", "CITY_OR_PROVINCE",
+    "DISTRICT", "ADDRESS_TEXT", "AWAIT_GEOLOCATION", "DELIVERY_DATE", "PAYMENT", "CONFIRM",
+)
+LANG, PERSON_TYPE, PHONE, NAME, QUANTITY, COMMENT, COMMENT_INPUT, CITY_OR_PROVINCE, DISTRICT, ADDRESS_TEXT, AWAIT_GEOLOCATION, DELIVERY_DATE, PAYMENT, CONFIRM = range(len(STATE_NAMES))
 
 # ===== TEXTS (uz/ru/en) =====
 TEXTS = {
@@ -87,6 +182,8 @@ TEXTS = {
         "share_contact": "📞 Kontaktni ulashish",
         "back_to_start": "🏠 Bosh sahifa — pastdagi tugmani bosing",
         "sunday_unavailable": "Eslatma: Yakshanba kuni ishlamaymiz — yakshanbalarni yetkazib berish sanalari orasida ko'rsatmaymiz.",
+        "out_of_area": "Kechirasiz, bu joylashuv yetkazib berish hududimizdan tashqarida. Iltimos, Toshkent shahri yoki viloyatidagi joylashuvni yuboring.",
+        "delivery_fee_line": "🚚 Yetkazib berish: {fee} {currency}",
     },
     "ru": {
         "welcome": "Добро пожаловать! Пожалуйста, выберите язык:",
@@ -120,6 +217,8 @@ TEXTS = {
         "share_contact": "📞 Поделиться контактом",
         "back_to_start": "🏠 Главная — нажмите кнопку ниже",
         "sunday_unavailable": "Примечание: по воскресеньям мы не работаем — воскресенья не доступны для доставки.",
+        "out_of_area": "Извините, эта локация вне зоны доставки. Пожалуйста, отправьте локацию в Ташкенте или Ташкентской области.",
+        "delivery_fee_line": "🚚 Доставка: {fee} {currency}",
     },
     "en": {
         "welcome": "Welcome! Please select your language:",
@@ -153,6 +252,8 @@ TEXTS = {
         "share_contact": "📞 Share Contact",
         "back_to_start": "🏠 Back to start — press the button below",
         "sunday_unavailable": "Note: We don't work on Sundays — Sundays are not available for delivery.",
+        "out_of_area": "Sorry, this location is outside our delivery area. Please send a location in Tashkent City or Province.",
+        "delivery_fee_line": "🚚 Delivery: {fee} {currency}",
     },
 }
 
@@ -201,6 +302,13 @@ DISTRICTS = {
     }
 }
 
+# any-language district name -> canonical (uz) name, used as the routing key
+DISTRICT_CANONICAL = {
+    name.casefold(): uz_name
+    for names in DISTRICTS["tashkent_city"].values()
+    for name, uz_name in zip(names, DISTRICTS["tashkent_city"]["uz"])
+}
+
 # ===== helpers =====
 def get_text_for_lang(lang: str, key: str) -> str:
     return TEXTS.get(lang, TEXTS["uz"]).get(key, key)
@@ -225,13 +333,34 @@ def is_home_text(text: str) -> bool:
             return True
     return False
 
-# load optional image bytes
-IMAGE_BYTES = None
-try:
-    with open(IMAGE_PATH, "rb") as f:
-        IMAGE_BYTES = f.read()
-except Exception:
-    logger.info("image not found; continuing without image")
+# optional product image: read from disk on first use, then sent by Telegram file_id
+_IMAGE_FILE_ID = None
+
+@functools.lru_cache(maxsize=None)
+def _image_bytes():
+    try:
+        with open(IMAGE_PATH, "rb") as f:
+            return f.read()
+    except Exception:
+        logger.info("image not found; continuing without image")
+        return None
+
+def product_photo():
+    """Photo argument for send/reply_photo, or None when there is no image."""
+    if _IMAGE_FILE_ID:
+        return _IMAGE_FILE_ID
+    data = _image_bytes()
+    if data is None:
+        return None
+    bio = io.BytesIO(data)
+    bio.name = "image.jpg"
+    return bio
+
+def remember_product_photo(message):
+    """Cache the file_id of an uploaded product photo so it is never uploaded again."""
+    global _IMAGE_FILE_ID
+    if _IMAGE_FILE_ID is None and message is not None and message.photo:
+        _IMAGE_FILE_ID = message.photo[-1].file_id
 
 # price caption builder
 def build_price_caption(qty: int, lang: str) -> str:
@@ -257,348 +386,882 @@ def districts_keyboard_for_lang(lang: str):
     rows.append([get_text_for_lang(lang, "back")])
     return rows
 
-# ===== Handlers =====
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data.clear()
-    context.user_data.setdefault("_history", [])
+# ===== Customer store (sqlite) =====
+# sqlite is blocking, so every call goes through asyncio.to_thread with one shared connection.
+_DB = None
+_DB_LOCK = threading.Lock()
+
+def _get_db():
+    global _DB
+    if _DB is None:
+        _DB = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _DB.execute("PRAGMA journal_mode=WAL")
+        _DB.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS customers (
+                chat_id INTEGER PRIMARY KEY,
+                lang TEXT,
+                name TEXT,
+                phone TEXT,
+                orders_count INTEGER NOT NULL DEFAULT 0,
+                last_order_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT,
+                photo_file_id TEXT,
+                admin_chat_id INTEGER,
+                progress_message_id INTEGER,
+                last_chat_id INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                removed INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'running',
+                created_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS digest_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                row TEXT NOT NULL,
+                created_at TEXT
+            );
+            """
+        )
+    return _DB
+
+def _db_run(sql: str, params=(), fetch: str = None):
+    with _DB_LOCK:
+        db = _get_db()
+        cur = db.execute(sql, params)
+        if fetch == "one":
+            result = cur.fetchone()
+        elif fetch == "all":
+            result = cur.fetchall()
+        else:
+            result = cur.lastrowid
+        db.commit()
+        return result
+
+async def db_run(sql: str, params=(), fetch: str = None):
+    return await asyncio.to_thread(_db_run, sql, params, fetch)
+
+async def save_customer(chat_id: int, ud: dict):
+    await db_run(
+        """
+        INSERT INTO customers (chat_id, lang, name, phone, orders_count, last_order_at)
+        VALUES (?, ?, ?, ?, 1, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET
+            lang = excluded.lang, name = excluded.name, phone = excluded.phone,
+            orders_count = customers.orders_count + 1, last_order_at = excluded.last_order_at
+        """,
+        (chat_id, ud.get("lang", "uz"), ud.get("name"), ud.get("phone"), datetime.now(TZ).isoformat()),
+    )
+
+async def iter_customer_pages(after_chat_id: int, page_size: int):
+    """Yield chat ids in ascending pages (keyset pagination), so huge tables are never fully loaded."""
+    cursor = after_chat_id
+    while True:
+        rows = await db_run(
+            "SELECT chat_id FROM customers WHERE chat_id > ? ORDER BY chat_id LIMIT ?",
+            (cursor, page_size),
+            fetch="all",
+        )
+        if not rows:
+            return
+        page = [r[0] for r in rows]
+        yield page
+        cursor = page[-1]
+
+# ===== Order delivery to operations chats =====
+_OUTBOX = set()  # pending target-chat send tasks, drained on shutdown
+SHUTTING_DOWN = asyncio.Event()
+
+def outbox_task(app, coro):
+    task = app.create_task(coro)
+    _OUTBOX.add(task)
+    task.add_done_callback(_OUTBOX.discard)
+    return task
+
+def _chat_ids(value) -> list:
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [int(v) for v in value]
+    return [int(value)]
+
+def load_order_routes() -> dict:
+    """Compile the routing table into {"districts": {uz_name: [chat ids]}, "city": [...], "province": [...], "default": [...]}.
+
+    Any problem with the table (bad JSON, wrong shape, non-numeric chat id) is logged and the
+    whole table is replaced by the default route, so orders always reach TARGET_CHAT_ID.
+    """
+    fallback = {"districts": {}, "city": [], "province": [], "default": [TARGET_CHAT_ID]}
+    try:
+        raw = {}
+        if ORDER_ROUTES:
+            raw = json.loads(ORDER_ROUTES)
+        elif os.path.exists(ORDER_ROUTES_PATH):
+            with open(ORDER_ROUTES_PATH, encoding="utf-8") as f:
+                raw = json.load(f)
+        if not isinstance(raw, dict):
+            raise ValueError("routing table must be a JSON object")
+        raw_districts = raw.get("districts") or {}
+        if not isinstance(raw_districts, dict):
+            raise ValueError('"districts" must be an object of district name -> chat id(s)')
+
+        districts = {}
+        for name, chats in raw_districts.items():
+            canonical = DISTRICT_CANONICAL.get(name.strip().casefold())
+            if canonical is None:
+                logger.warning("Unknown district in routing table: %s", name)
+                continue
+            districts[canonical] = _chat_ids(chats)
+
+        return {
+            "districts": districts,
+            "city": _chat_ids(raw.get("city")),
+            "province": _chat_ids(raw.get("province")),
+            "default": _chat_ids(raw.get("default")) or [TARGET_CHAT_ID],
+        }
+    except Exception:
+        logger.exception("Invalid order routing table; sending every order to TARGET_CHAT_ID")
+        return fallback
+
+@functools.lru_cache(maxsize=None)
+def get_order_routes() -> dict:
+    return load_order_routes()
+
+def route_order(ud: dict) -> list:
+    """Target chats for an order: district route, then city/province route, then the default."""
+    table = get_order_routes()
+    area_choice = ud.get("area_choice")
+    if area_choice == "city":
+        canonical = DISTRICT_CANONICAL.get((ud.get("district") or "").strip().casefold())
+        if canonical in table["districts"]:
+            return table["districts"][canonical]
+        if table["city"]:
+            return table["city"]
+    elif area_choice == "province" and table["province"]:
+        return table["province"]
+    return table["default"]
+
+# buffered orders are also kept in the digest_queue table until their batch is delivered,
+# so a restart or a failed send does not lose them
+_DIGEST_BUFFER = {}  # chat_id -> list of (digest_queue id, order text, order row)
+_DIGEST_TIMERS = {}  # chat_id -> asyncio.TimerHandle of the pending window flush
+_DIGEST_SENDING = set()  # digest_queue ids of batches being sent right now
+DIGEST_SEPARATOR = "\n➖➖➖➖➖\n\n"
+
+async def send_to_target_chat(bot, chat_id: int, text: str = None, document=None, caption: str = None):
+    """Send to an operations chat, honouring RetryAfter; failures are logged, never raised."""
+    for _ in range(3):
+        try:
+            if document is not None:
+                await bot.send_document(chat_id=chat_id, document=document, caption=caption)
+            else:
+                await bot.send_message(chat_id=chat_id, text=text)
+            return True
+        except RetryAfter as e:
+            logger.warning("RetryAfter while sending to %s, sleeping %s s", chat_id, e.retry_after)
+            await asyncio.sleep(e.retry_after)
+            if document is not None:
+                document.seek(0)
+        except TimedOut:
+            logger.warning("TimedOut while sending order to target chat - ignored (will not crash).")
+            return False
+        except Exception:
+            logger.exception("Failed to send order to target chat")
+            return False
+    return False
 
-    if IMAGE_BYTES:
-        bio = io.BytesIO(IMAGE_BYTES)
-        bio.name = "image.jpg"
-        if getattr(update, "message", None):
-            await update.message.reply_photo(photo=bio)
+def split_message_chunks(parts, limit: int = TELEGRAM_MAX_MESSAGE, separator: str = DIGEST_SEPARATOR):
+    """Pack `parts` into as few messages as possible, never splitting a part unless it alone exceeds `limit`."""
+    chunks = []
+    current = ""
+    for part in parts:
+        while len(part) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(part[:limit])
+            part = part[limit:]
+        candidate = f"{current}{separator}{part}" if current else part
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = part
         else:
-            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=bio)
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+def build_digest_csv(rows) -> io.BytesIO:
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=list(rows[0].keys()))
+    writer.writeheader()
+    writer.writerows(rows)
+    # utf-8-sig so Excel opens Cyrillic/Uzbek text correctly
+    bio = io.BytesIO(buf.getvalue().encode("utf-8-sig"))
+    bio.name = f"orders_{datetime.now(TZ).strftime('%Y%m%d_%H%M%S')}.csv"
+    return bio
+
+def _arm_digest_timer(app, chat_id: int):
+    if chat_id not in _DIGEST_TIMERS:
+        loop = asyncio.get_running_loop()
+        _DIGEST_TIMERS[chat_id] = loop.call_later(
+            ORDER_DIGEST_WINDOW, lambda: outbox_task(app, flush_digest(app, chat_id))
+        )
 
-    lang_row = ["🇺🇿 Uzbek", "🇷🇺 Russian", "🇬🇧 English"]
-    keyboard = [lang_row]
-    if getattr(update, "message", None):
-        await update.message.reply_text(TEXTS["uz"]["welcome"], reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+def _digest_messages(header: str, items):
+    """Pack the digest like split_message_chunks, keeping which items each group of messages carries."""
+    groups = []
+    parts, group = [header], []
+    for item in items:
+        if group and len(split_message_chunks(parts + [item[1]])) > 1:
+            groups.append((split_message_chunks(parts), group))
+            parts, group = [], []
+        parts.append(item[1])
+        group.append(item)
+    groups.append((split_message_chunks(parts), group))
+    return groups
+
+async def _send_digest(bot, chat_id: int, items) -> list:
+    """Return the items that reached the chat; a failed message stops the batch."""
+    header = f"📦 Buyurtmalar to'plami: {len(items)} ta"
+    if ORDER_DIGEST_MODE == "csv":
+        document = build_digest_csv([row for _, _, row in items])
+        return items if await send_to_target_chat(bot, chat_id, document=document, caption=header) else []
+
+    delivered = []
+    for chunks, group in _digest_messages(header, items):
+        for chunk in chunks:
+            if not await send_to_target_chat(bot, chat_id, chunk):
+                return delivered
+        delivered.extend(group)
+    return delivered
+
+async def flush_digest(app, chat_id: int):
+    """Send the chat's buffered orders as one batch; they leave digest_queue only once delivered."""
+    timer = _DIGEST_TIMERS.pop(chat_id, None)
+    if timer:
+        timer.cancel()
+    items = _DIGEST_BUFFER.pop(chat_id, [])
+    if not items:
+        return
+
+    ids = [item_id for item_id, _, _ in items if item_id is not None]
+    _DIGEST_SENDING.update(ids)
+    try:
+        delivered = await _send_digest(app.bot, chat_id, items)
+        done_ids = [item_id for item_id, _, _ in delivered if item_id is not None]
+        if done_ids:
+            await db_run(f"DELETE FROM digest_queue WHERE id IN ({','.join('?' * len(done_ids))})", done_ids)
+    finally:
+        _DIGEST_SENDING.difference_update(ids)
+
+    remaining = items[len(delivered):]
+    if remaining:
+        # put the undelivered rest back in front of newer orders; it stays in digest_queue meanwhile
+        _DIGEST_BUFFER[chat_id] = remaining + _DIGEST_BUFFER.get(chat_id, [])
+        if not SHUTTING_DOWN.is_set():
+            logger.warning("Digest for %s not delivered, retrying in %s s", chat_id, ORDER_DIGEST_WINDOW)
+            _arm_digest_timer(app, chat_id)
+
+async def queue_order_for_digest(app, chat_id: int, text: str, row: dict):
+    try:
+        item_id = await db_run(
+            "INSERT INTO digest_queue (chat_id, text, row, created_at) VALUES (?, ?, ?, ?)",
+            (chat_id, text, json.dumps(row, ensure_ascii=False), datetime.now(TZ).isoformat()),
+        )
+    except Exception:
+        logger.exception("Failed to persist digest order for %s (kept in memory only)", chat_id)
+        item_id = None
+
+    buf = _DIGEST_BUFFER.setdefault(chat_id, [])
+    buf.append((item_id, text, row))
+    if len(buf) >= ORDER_DIGEST_MAX:
+        outbox_task(app, flush_digest(app, chat_id))
     else:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=TEXTS["uz"]["welcome"], reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-    return LANG
+        _arm_digest_timer(app, chat_id)
+
+def flush_all_digests(app):
+    for chat_id in list(_DIGEST_BUFFER):
+        outbox_task(app, flush_digest(app, chat_id))
+
+async def restore_digests(app):
+    """Re-buffer orders a previous run queued but never delivered and send them right away."""
+    known = set(_DIGEST_SENDING)
+    for items in _DIGEST_BUFFER.values():
+        known.update(item_id for item_id, _, _ in items)
+    rows = await db_run("SELECT id, chat_id, text, row FROM digest_queue ORDER BY id", fetch="all")
+    restored = collections.defaultdict(list)
+    for item_id, chat_id, text, row in rows:
+        if item_id not in known:
+            restored[chat_id].append((item_id, text, json.loads(row)))
+    for chat_id, items in restored.items():
+        _DIGEST_BUFFER[chat_id] = items + _DIGEST_BUFFER.get(chat_id, [])
+        outbox_task(app, flush_digest(app, chat_id))
+    if restored:
+        logger.info("Restored %s undelivered digest orders", sum(len(v) for v in restored.values()))
+
+# ===== Delivery area & address pre-processing =====
+# Runs after location capture: bounding-region check, distance from the depot, delivery
+# zone/fee (cached per grid cell) and street normalization against the local gazetteer.
+def _parse_bbox(value: str):
+    lat_min, lon_min, lat_max, lon_max = (float(x) for x in value.split(","))
+    return lat_min, lon_min, lat_max, lon_max
+
+def _parse_zones(value: str):
+    zones = [(float(z["max_km"]), str(z["zone"]), int(z["fee"])) for z in json.loads(value)]
+    return sorted(zones)
+
+SERVICE_BBOX = _parse_bbox(SERVICE_AREA)
+ZONES = _parse_zones(DELIVERY_ZONES)
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+def grid_cell(lat: float, lon: float):
+    return (math.floor(lat / GEO_GRID_DEG), math.floor(lon / GEO_GRID_DEG))
+
+@functools.lru_cache(maxsize=4096)
+def delivery_info_for_cell(cell) -> dict:
+    """Zone and fee for a grid cell (computed at the cell centre), or None outside the service area."""
+    lat = (cell[0] + 0.5) * GEO_GRID_DEG
+    lon = (cell[1] + 0.5) * GEO_GRID_DEG
+    lat_min, lon_min, lat_max, lon_max = SERVICE_BBOX
+    if not (lat_min <= lat <= lat_max and lon_min <= lon <= lon_max):
+        return None
+    distance = haversine_km(DEPOT_LAT, DEPOT_LON, lat, lon)
+    for max_km, zone, fee in ZONES:
+        if distance <= max_km:
+            return {"zone": zone, "fee": fee, "distance_km": round(distance, 1)}
+    return None
+
+# --- street gazetteer with a character trigram index ---
+_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "ғ": "g", "д": "d", "е": "e", "ё": "yo", "ж": "j", "з": "z",
+    "и": "i", "й": "y", "к": "k", "қ": "q", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r",
+    "с": "s", "т": "t", "у": "u", "ў": "o", "ф": "f", "х": "x", "ҳ": "h", "ц": "s", "ч": "ch", "ш": "sh",
+    "щ": "sh", "ъ": "", "ы": "i", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+    "ʻ": "", "ʼ": "", "’": "", "‘": "", "`": "", "'": "",
+})
+STREET_STOPWORDS = {
+    "kochasi", "kocha", "kuchasi", "kucha", "shoh", "yoli", "tor", "berk", "ulitsa", "ul", "prospekt",
+    "pr", "street", "st", "avenue", "ave", "uy", "dom", "kv", "kvartira", "xonadon", "apt", "house",
+}
 
-async def lang_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (update.message.text or "").strip()
-    if is_home_text(text):
-        return await start(update, context)
+# comma-separated address parts naming the district/city rather than the street
+AREA_MARKERS = {"tumani", "tuman", "rayon", "raion", "district", "viloyati", "viloyat", "oblast", "shahri", "shahar", "gorod", "city"}
+# "<massiv> N-kvartal": the word before such a marker names a neighbourhood, not a street, even
+# when it doubles as a street name ("Yunusobod 4-kvartal", "Chilonzor 20 kvartal")
+NEIGHBOURHOOD_MARKERS = {
+    "kvartal", "kvartali", "kvartaly", "mavze", "mavzesi", "mavzei", "massiv", "massivi", "mahalla",
+    "mahallasi", "mfy", "mikrorayon", "mikroraion", "mkr", "mkrn", "microdistrict",
+}
 
-    low = text.lower()
-    if "рус" in low or "ru" in low or "russian" in low or "рос" in low:
-        context.user_data["lang"] = "ru"
-    elif "uz" in low or "ўz" in low or "uzbek" in low or "uz" in low or "ўз" in low:
-        context.user_data["lang"] = "uz"
-    else:
-        context.user_data["lang"] = "en"
+def normalize_for_match(text: str) -> str:
+    t = text.casefold().translate(_TRANSLIT)
+    t = re.sub(r"[^a-z0-9 ]+", " ", t)
+    return " ".join(w for w in t.split() if w not in STREET_STOPWORDS and not w.isdigit())
+
+def _trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class StreetGazetteer:
+    """Fuzzy street lookup: a trigram inverted index shortlists candidates, Dice similarity ranks them."""
+
+    def __init__(self, names):
+        self.names = []
+        self.keys = []
+        self.grams = []
+        self.index = collections.defaultdict(set)
+        for name in names:
+            key = normalize_for_match(name)
+            if not key:
+                continue
+            i = len(self.names)
+            self.names.append(name)
+            self.keys.append(key)
+            self.grams.append(_trigrams(key))
+            for g in self.grams[i]:
+                self.index[g].add(i)
+
+    @classmethod
+    def from_file(cls, path: str):
+        try:
+            with open(path, encoding="utf-8") as f:
+                names = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        except FileNotFoundError:
+            logger.info("street gazetteer %s not found; addresses are kept as typed", path)
+            names = []
+        return cls(names)
+
+    def match(self, address: str):
+        """Best (canonical name, score 0..1) for any 1-3 word window of the address, or None."""
+        words = []
+        for part in address.split(","):
+            part_words = normalize_for_match(part).split()
+            if AREA_MARKERS & set(part_words):
+                continue
+            for i, w in enumerate(part_words):
+                nxt = part_words[i + 1] if i + 1 < len(part_words) else ""
+                if w not in NEIGHBOURHOOD_MARKERS and nxt not in NEIGHBOURHOOD_MARKERS:
+                    words.append(w)
+        best = None
+        for size in (3, 2, 1):
+            for i in range(len(words) - size + 1):
+                query = " ".join(words[i:i + size])
+                q = _trigrams(query)
+                hits = collections.Counter(idx for g in q if g in self.index for idx in self.index[g])
+                for idx, shared in hits.most_common(5):
+                    score = 2 * shared / (len(q) + len(self.grams[idx]))
+                    if len(query) >= 4:
+                        # "Navoiy" should still find "Alisher Navoiy": reward queries contained in a name
+                        score = max(score, 0.9 * shared / len(q))
+                    if best is None or score > best[1]:
+                        best = (self.names[idx], score)
+        if best and best[1] >= STREET_MATCH_MIN_SCORE:
+            return best
+        return None
 
-    history = context.user_data.setdefault("_history", [])
-    history.append(LANG)
+@functools.lru_cache(maxsize=None)
+def get_gazetteer() -> StreetGazetteer:
+    return StreetGazetteer.from_file(STREETS_PATH)
 
-    buttons = [[b] for b in get_text(context.user_data, "person_buttons")]
-    buttons.append([get_text(context.user_data, "back")])
-    await update.message.reply_text(get_text(context.user_data, "ask_person"), reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
-    return PERSON_TYPE
+@functools.lru_cache(maxsize=2048)
+def normalize_address(address: str):
+    return get_gazetteer().match(address)
 
-async def person_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == get_text(context.user_data, "back"):
-        return await render_state_from_history(update, context)
+async def preprocess_delivery(lat: float, lon: float, address: str):
+    """Delivery info for a captured location, or None when it is outside the service area."""
+    info = delivery_info_for_cell(grid_cell(lat, lon))
+    if info is None:
+        return None
+    info = dict(info)
+    if address:
+        # the first call loads and indexes the gazetteer; keep that off the event loop
+        street = await asyncio.to_thread(normalize_address, address)
+        if street:
+            info["street"], info["street_score"] = street[0], round(street[1], 2)
+    return info
+
+# ===== Conversation engine =====
+# Every state is one declarative Screen: how it is rendered (prompt + keyboard) and how
+# its input is parsed into the next state. The table is compiled once into STATE_DISPATCH,
+# so forward and back navigation share render_screen() and dispatch is a dict lookup.
+STAY = -1  # input consumed, nothing to redraw (e.g. tapping the quantity counter)
+REDRAW = -2  # redraw the current screen in place (edit the existing message)
+
+class Screen(NamedTuple):
+    prompt: Callable  # (user_data) -> text / caption
+    keyboard: Callable  # (user_data) -> reply markup
+    parse: Optional[Callable] = None  # async (update, context) -> next state | None (re-ask) | STAY | REDRAW
+    input_filter: object = None  # message screens: PTB filter
+    pattern: Optional[str] = None  # inline screens: callback data regex
+    photo: bool = False  # render as IMAGE caption when the image is available
+    notice: Optional[Callable] = None  # (user_data) -> extra message sent before the prompt
+
+TEXT_INPUT = filters.TEXT & ~filters.COMMAND
+LANG_BUTTONS = ["🇺🇿 Uzbek", "🇷🇺 Russian", "🇬🇧 English"]
+
+def _text(key: str):
+    return lambda ud: get_text(ud, key)
+
+def _message_text(update: Update) -> str:
+    return (update.message.text or "").strip() if update.message else ""
+
+def delivery_date_options(count: int = 5):
+    """Next `count` delivery dates starting from tomorrow, skipping Sundays (TZ-aware)."""
+    options = []
+    d = datetime.now(TZ).date() + timedelta(days=1)
+    while len(options) < count:
+        # weekday(): Monday=0 ... Sunday=6
+        if d.weekday() != 6:
+            options.append(d.strftime("%Y-%m-%d"))
+        d += timedelta(days=1)
+    return options
 
-    context.user_data.setdefault("_history", []).append(PERSON_TYPE)
-    context.user_data["person_type"] = text
+# --- keyboards ---
+def _lang_keyboard(ud):
+    return ReplyKeyboardMarkup([LANG_BUTTONS], resize_keyboard=True)
 
-    contact_button = KeyboardButton(text=get_text(context.user_data, "share_contact"), request_contact=True)
-    keyboard = [[contact_button], [get_text(context.user_data, "back")]]
-    await update.message.reply_text(get_text(context.user_data, "ask_phone"), reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
-    return PHONE
+def _person_keyboard(ud):
+    buttons = [[b] for b in get_text(ud, "person_buttons")]
+    buttons.append([get_text(ud, "back")])
+    return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
 
-async def received_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    t = update.message.text or ""
-    if t == get_text(context.user_data, "back"):
-        return await render_state_from_history(update, context)
+def _phone_keyboard(ud):
+    contact_button = KeyboardButton(text=get_text(ud, "share_contact"), request_contact=True)
+    return ReplyKeyboardMarkup([[contact_button], [get_text(ud, "back")]], resize_keyboard=True)
 
-    phone = None
-    if update.message.contact and getattr(update.message.contact, "phone_number", None):
-        phone = update.message.contact.phone_number
-    else:
-        phone = safe_normalize_phone(update.message.text or "")
+def _no_keyboard(ud):
+    return ReplyKeyboardRemove()
 
-    if not phone:
-        await update.message.reply_text(get_text(context.user_data, "ask_phone"))
-        return PHONE
+def _quantity_keyboard(ud):
+    return build_qty_markup(ud.get("quantity", 2), ud.get("lang", "uz"))
 
-    context.user_data.setdefault("_history", []).append(PHONE)
-    context.user_data["phone"] = phone
+def _comment_keyboard(ud):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_text(ud, "yes"), callback_data="comment_yes"),
+         InlineKeyboardButton(get_text(ud, "no"), callback_data="comment_no")],
+        [InlineKeyboardButton(get_text(ud, "back"), callback_data="back_any")],
+    ])
 
-    await update.message.reply_text(get_text(context.user_data, "ask_name"), reply_markup=ReplyKeyboardRemove())
-    return NAME
+def _area_keyboard(ud):
+    return ReplyKeyboardMarkup([
+        [get_text(ud, "tashkent_city_button")],
+        [get_text(ud, "tashkent_province_button")],
+        [get_text(ud, "back")],
+    ], resize_keyboard=True)
 
-async def received_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    t = update.message.text or ""
-    if t == get_text(context.user_data, "back"):
-        return await render_state_from_history(update, context)
+def _district_keyboard(ud):
+    return ReplyKeyboardMarkup(districts_keyboard_for_lang(ud.get("lang", "uz")), resize_keyboard=True)
 
-    context.user_data.setdefault("_history", []).append(NAME)
-    context.user_data["name"] = (update.message.text or "").strip()
-    context.user_data["quantity"] = context.user_data.get("quantity", 2)
+def _location_keyboard(ud):
+    loc_button = KeyboardButton("📍 Send Location", request_location=True)
+    return ReplyKeyboardMarkup([[loc_button], [get_text(ud, "back")]], resize_keyboard=True)
+
+def _delivery_keyboard(ud):
+    buttons = [[InlineKeyboardButton(x, callback_data=f"date_{x}")] for x in delivery_date_options()]
+    buttons.append([InlineKeyboardButton(get_text(ud, "back"), callback_data="back_any")])
+    return InlineKeyboardMarkup(buttons)
+
+def _payment_keyboard(ud):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_text(ud, "card"), callback_data="card"),
+         InlineKeyboardButton(get_text(ud, "cash"), callback_data="cash")],
+        [InlineKeyboardButton(get_text(ud, "back"), callback_data="back_any")],
+    ])
+
+def _confirm_keyboard(ud):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_text(ud, "order_button"), callback_data="place_order")],
+        [InlineKeyboardButton(get_text(ud, "back"), callback_data="back_any")],
+    ])
+
+def _quantity_prompt(ud):
+    qty = ud.get("quantity", 2)
+    return f"{get_text(ud, 'ask_quantity')}\n\n{build_price_caption(qty, ud.get('lang', 'uz'))}"
+
+def _confirm_prompt(ud):
+    text = get_text(ud, "order_button")
+    delivery = ud.get("delivery")
+    if delivery:
+        text += "\n" + get_text(ud, "delivery_fee_line").format(fee=delivery["fee"], currency=CURRENCY)
+    return text
+
+# --- input parsers ---
+async def _parse_lang(update, context):
+    low = _message_text(update).lower()
+    if "рус" in low or "ru" in low or "russian" in low or "рос" in low:
+        context.user_data["lang"] = "ru"
+    elif "uz" in low or "ўz" in low or "uzbek" in low or "ўз" in low:
+        context.user_data["lang"] = "uz"
+    else:
+        context.user_data["lang"] = "en"
+    return PERSON_TYPE
 
-    qty = context.user_data["quantity"]
-    price_caption = build_price_caption(qty, context.user_data["lang"])
-    markup = build_qty_markup(qty, context.user_data["lang"])
-    prompt = f"{get_text(context.user_data, 'ask_quantity')}\n\n{price_caption}"
+async def _parse_person(update, context):
+    context.user_data["person_type"] = update.message.text
+    return PHONE
 
-    if IMAGE_BYTES:
-        bio = io.BytesIO(IMAGE_BYTES)
-        bio.name = "image.jpg"
-        await update.message.reply_photo(photo=bio, caption=prompt, reply_markup=markup)
+async def _parse_phone(update, context):
+    contact = update.message.contact
+    if contact and getattr(contact, "phone_number", None):
+        phone = contact.phone_number
     else:
-        await update.message.reply_text(prompt, reply_markup=markup)
+        phone = safe_normalize_phone(update.message.text or "")
+    if not phone:
+        return None
+    context.user_data["phone"] = phone
+    return NAME
 
+async def _parse_name(update, context):
+    context.user_data["name"] = _message_text(update)
+    context.user_data.setdefault("quantity", 2)
     return QUANTITY
 
-async def quantity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
+async def _parse_quantity(update, context):
+    data = update.callback_query.data
     qty = context.user_data.get("quantity", 2)
-
     if data == "incr":
-        qty += 1
-        context.user_data["quantity"] = qty
-    elif data == "decr":
-        if qty > 2:
-            qty -= 1
-            context.user_data["quantity"] = qty
-        else:
-            qty = 2
-            context.user_data["quantity"] = qty
-    elif data == "count":
-        return QUANTITY
-    elif data == "continue_qty":
-        qty = context.user_data.get("quantity", 2)
-        if qty < 2:
-            await query.answer("Please choose at least 2.", show_alert=True)
-            return QUANTITY
-        context.user_data.setdefault("_history", []).append(QUANTITY)
-        await query.message.reply_text(get_text(context.user_data, "ask_comment_question"), reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton(get_text(context.user_data, "yes"), callback_data="comment_yes"),
-             InlineKeyboardButton(get_text(context.user_data, "no"), callback_data="comment_no")],
-            [InlineKeyboardButton(get_text(context.user_data, "back"), callback_data="back_any")],
-        ]))
+        context.user_data["quantity"] = qty + 1
+        return REDRAW
+    if data == "decr":
+        context.user_data["quantity"] = max(2, qty - 1)
+        return REDRAW
+    if data == "continue_qty":
         return COMMENT
+    return STAY
 
-    new_markup = build_qty_markup(qty, context.user_data["lang"])
-    price_caption = build_price_caption(qty, context.user_data["lang"])
-    try:
-        if query.message.photo:
-            await query.edit_message_caption(caption=f"{get_text(context.user_data, 'ask_quantity')}\n\n{price_caption}", reply_markup=new_markup)
-        else:
-            await query.edit_message_text(text=f"{get_text(context.user_data, 'ask_quantity')}\n\n{price_caption}", reply_markup=new_markup)
-    except BadRequest as e:
-        if "Message is not modified" in str(e):
-            return QUANTITY
-        logger.exception("BadRequest while editing markup: %s", e)
-        return QUANTITY
-    except RetryAfter as e:
-        logger.warning("RetryAfter while editing markup: %s", e)
-        return QUANTITY
-    except Exception as e:
-        logger.exception("Unexpected error editing markup: %s", e)
-        return QUANTITY
-
-    return QUANTITY
-
-async def comment_choice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-
-    if data == "back_any":
-        return await render_state_from_history(update, context)
-
+async def _parse_comment_choice(update, context):
+    data = update.callback_query.data
     if data == "comment_no":
-        context.user_data.setdefault("_history", []).append(COMMENT)
         # Izoh yo'q → darhol shahar/viloyat tanlash
-        lang = context.user_data.get("lang", "uz")
-        buttons = [
-            [get_text_for_lang(lang, "tashkent_city_button")],
-            [get_text_for_lang(lang, "tashkent_province_button")],
-            [get_text_for_lang(lang, "back")],
-        ]
-        await query.message.reply_text(
-            get_text_for_lang(lang, "ask_city_or_province"),
-            reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True),
-        )
+        context.user_data.pop("comment", None)
         return CITY_OR_PROVINCE
-
     if data == "comment_yes":
-        context.user_data.setdefault("_history", []).append(COMMENT)
-        await query.message.reply_text(get_text(context.user_data, "ask_comment"), reply_markup=ReplyKeyboardRemove())
         return COMMENT_INPUT
+    return STAY
 
-    return COMMENT
-
-async def comment_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    t = update.message.text or ""
-    if t == get_text(context.user_data, "back"):
-        return await render_state_from_history(update, context)
-
-    context.user_data.setdefault("_history", []).append(COMMENT_INPUT)
-    context.user_data["comment"] = (update.message.text or "").strip()
-
-    # Izohdan keyin → shahar/viloyat tanlash
-    lang = context.user_data.get("lang", "uz")
-    buttons = [
-        [get_text_for_lang(lang, "tashkent_city_button")],
-        [get_text_for_lang(lang, "tashkent_province_button")],
-        [get_text_for_lang(lang, "back")],
-    ]
-    await update.message.reply_text(
-        get_text_for_lang(lang, "ask_city_or_province"),
-        reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True),
-    )
+async def _parse_comment(update, context):
+    context.user_data["comment"] = _message_text(update)
     return CITY_OR_PROVINCE
 
-async def choose_city_or_province(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    t = (update.message.text or "").strip()
-    lang = context.user_data.get("lang", "uz")
-
-    if t == get_text_for_lang(lang, "back"):
-        return await render_state_from_history(update, context)
-
-    city_btn = get_text_for_lang(lang, "tashkent_city_button")
-    province_btn = get_text_for_lang(lang, "tashkent_province_button")
-
-    if t == city_btn:
-        # User chose Tashkent City -> show districts
-        context.user_data.setdefault("_history", []).append(CITY_OR_PROVINCE)
-        context.user_data["area_choice"] = "city"
-
-        rows = districts_keyboard_for_lang(lang)
-        await update.message.reply_text(
-            get_text_for_lang(lang, "ask_district"),
-            reply_markup=ReplyKeyboardMarkup(rows, resize_keyboard=True),
-        )
+async def _parse_area(update, context):
+    t = _message_text(update)
+    ud = context.user_data
+    if t == get_text(ud, "tashkent_city_button"):
+        ud["area_choice"] = "city"
         return DISTRICT
-
-    if t == province_btn:
-        # User chose Tashkent Province -> skip district step
-        context.user_data.setdefault("_history", []).append(CITY_OR_PROVINCE)
-        context.user_data["area_choice"] = "province"
-        await update.message.reply_text(get_text_for_lang(lang, "ask_address_text"), reply_markup=ReplyKeyboardRemove())
+    if t == get_text(ud, "tashkent_province_button"):
+        # Viloyat tanlansa tuman bosqichi o'tkazib yuboriladi
+        ud["area_choice"] = "province"
+        ud.pop("district", None)
         return ADDRESS_TEXT
+    return None
 
-    # If unexpected text, re-ask
-    buttons = [
-        [city_btn],
-        [province_btn],
-        [get_text_for_lang(lang, "back")],
-    ]
-    await update.message.reply_text(
-        get_text_for_lang(lang, "ask_city_or_province"),
-        reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True),
-    )
-    return CITY_OR_PROVINCE
-
-async def received_district(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    t = (update.message.text or "").strip()
-    if t == get_text(context.user_data, "back"):
-        return await render_state_from_history(update, context)
-
-    context.user_data.setdefault("_history", []).append(DISTRICT)
-    context.user_data["district"] = t
-
-    await update.message.reply_text(get_text(context.user_data, "ask_address_text"), reply_markup=ReplyKeyboardRemove())
+async def _parse_district(update, context):
+    context.user_data["district"] = _message_text(update)
     return ADDRESS_TEXT
 
-async def received_address_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    t = (update.message.text or "").strip()
-    if t == get_text(context.user_data, "back"):
-        return await render_state_from_history(update, context)
-
-    context.user_data.setdefault("_history", []).append(ADDRESS_TEXT)
-    context.user_data["address_text"] = t
-
-    loc_button = KeyboardButton("📍 Send Location", request_location=True)
-    keyboard = [[loc_button], [get_text(context.user_data, "back")]]
-    await update.message.reply_text(get_text(context.user_data, "ask_location"), reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+async def _parse_address(update, context):
+    context.user_data["address_text"] = _message_text(update)
     return AWAIT_GEOLOCATION
 
-async def received_geo_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    t = update.message.text or ""
-    if t == get_text(context.user_data, "back"):
-        return await render_state_from_history(update, context)
-
-    if not update.message.location:
-        await update.message.reply_text(get_text(context.user_data, "ask_location"))
-        return AWAIT_GEOLOCATION
-
-    context.user_data.setdefault("_history", []).append(AWAIT_GEOLOCATION)
+async def _parse_location(update, context):
     loc = update.message.location
-    context.user_data["location"] = {"lat": loc.latitude, "lon": loc.longitude}
-
-    # Generate next 5 available delivery dates starting from tomorrow excluding Sundays (use TZ)
-    lang = context.user_data.get("lang", "uz")
-    today = datetime.now(TZ).date()
-    options = []
-    d = today + timedelta(days=1)
-    while len(options) < 5:
-        # weekday(): Monday=0 ... Sunday=6
-        if d.weekday() == 6:
-            d += timedelta(days=1)
-            continue
-        options.append(d.strftime("%Y-%m-%d"))
-        d += timedelta(days=1)
-
-    try:
-        await update.message.reply_text(get_text_for_lang(lang, "sunday_unavailable"))
-    except Exception:
-        logger.exception("Failed to send sunday_unavailable message (ignored)")
-
-    buttons = [[InlineKeyboardButton(x, callback_data=f"date_{x}")] for x in options]
-    buttons.append([InlineKeyboardButton(get_text(context.user_data, "back"), callback_data="back_any")])
-    await update.message.reply_text(get_text(context.user_data, "ask_delivery"), reply_markup=InlineKeyboardMarkup(buttons))
+    if not loc:
+        return None
+    ud = context.user_data
+    delivery = await preprocess_delivery(loc.latitude, loc.longitude, ud.get("address_text", ""))
+    if delivery is None:
+        await update.message.reply_text(get_text(ud, "out_of_area"))
+        return None
+    ud["location"] = {"lat": loc.latitude, "lon": loc.longitude}
+    ud["delivery"] = delivery
     return DELIVERY_DATE
 
-async def delivery_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-
-    if data == "back_any":
-        return await render_state_from_history(update, context)
-
+async def _parse_delivery(update, context):
+    data = update.callback_query.data
     if data.startswith("date_"):
-        date = data.split("_", 1)[1]
-        context.user_data.setdefault("_history", []).append(DELIVERY_DATE)
-        context.user_data["delivery_date"] = date
-
-        buttons = [
-            [InlineKeyboardButton(get_text(context.user_data, "card"), callback_data="card"),
-             InlineKeyboardButton(get_text(context.user_data, "cash"), callback_data="cash")],
-            [InlineKeyboardButton(get_text(context.user_data, "back"), callback_data="back_any")],
-        ]
-        await query.message.reply_text(get_text(context.user_data, "ask_payment"), reply_markup=InlineKeyboardMarkup(buttons))
+        context.user_data["delivery_date"] = data.split("_", 1)[1]
         return PAYMENT
+    return STAY
 
-    return DELIVERY_DATE
+async def _parse_payment(update, context):
+    data = update.callback_query.data
+    if data in ("card", "cash"):
+        context.user_data["payment"] = get_text(context.user_data, data)
+        return CONFIRM
+    return STAY
+
+SCREENS = {
+    LANG: Screen(lambda ud: TEXTS["uz"]["welcome"], _lang_keyboard, _parse_lang, input_filter=TEXT_INPUT),
+    PERSON_TYPE: Screen(_text("ask_person"), _person_keyboard, _parse_person, input_filter=TEXT_INPUT),
+    PHONE: Screen(_text("ask_phone"), _phone_keyboard, _parse_phone, input_filter=filters.CONTACT | TEXT_INPUT),
+    NAME: Screen(_text("ask_name"), _no_keyboard, _parse_name, input_filter=TEXT_INPUT),
+    QUANTITY: Screen(_quantity_prompt, _quantity_keyboard, _parse_quantity, pattern=r"^(incr|decr|count|continue_qty)$", photo=True),
+    COMMENT: Screen(_text("ask_comment_question"), _comment_keyboard, _parse_comment_choice, pattern=r"^(comment_yes|comment_no|back_any)$"),
+    COMMENT_INPUT: Screen(_text("ask_comment"), _no_keyboard, _parse_comment, input_filter=TEXT_INPUT),
+    CITY_OR_PROVINCE: Screen(_text("ask_city_or_province"), _area_keyboard, _parse_area, input_filter=TEXT_INPUT),
+    DISTRICT: Screen(_text("ask_district"), _district_keyboard, _parse_district, input_filter=TEXT_INPUT),
+    ADDRESS_TEXT: Screen(_text("ask_address_text"), _no_keyboard, _parse_address, input_filter=TEXT_INPUT),
+    AWAIT_GEOLOCATION: Screen(_text("ask_location"), _location_keyboard, _parse_location, input_filter=filters.LOCATION | TEXT_INPUT),
+    DELIVERY_DATE: Screen(_text("ask_delivery"), _delivery_keyboard, _parse_delivery, pattern=r"^(date_.*|back_any)$", notice=_text("sunday_unavailable")),
+    PAYMENT: Screen(_text("ask_payment"), _payment_keyboard, _parse_payment, pattern=r"^(card|cash|back_any)$"),
+    # placing the order is a side effect, not a table transition: see final_place_order_handler
+    CONFIRM: Screen(_confirm_prompt, _confirm_keyboard, pattern=r"^(place_order|back_any)$"),
+}
 
-async def payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
+async def render_screen(update: Update, context: ContextTypes.DEFAULT_TYPE, state: int, edit: bool = False) -> int:
+    """The single rendering path for every state, used for forward, back and re-ask alike."""
+    screen = SCREENS[state]
+    ud = context.user_data
+    ud["_state"] = state
+    ud["_seen"] = time.time()
+    target = update.effective_message
+    text = screen.prompt(ud)
+    markup = screen.keyboard(ud)
+
+    if edit:
+        query = update.callback_query
+        try:
+            if query.message.photo:
+                await query.edit_message_caption(caption=text, reply_markup=markup)
+            else:
+                await query.edit_message_text(text=text, reply_markup=markup)
+        except BadRequest as e:
+            if "Message is not modified" not in str(e):
+                logger.exception("BadRequest while editing markup: %s", e)
+        except RetryAfter as e:
+            logger.warning("RetryAfter while editing markup: %s", e)
+        except Exception as e:
+            logger.exception("Unexpected error editing markup: %s", e)
+        return state
+
+    if screen.notice:
+        try:
+            await target.reply_text(screen.notice(ud))
+        except Exception:
+            logger.exception("Failed to send notice message (ignored)")
 
-    if data == "back_any":
-        return await render_state_from_history(update, context)
+    photo = product_photo() if screen.photo else None
+    if photo:
+        remember_product_photo(await target.reply_photo(photo=photo, caption=text, reply_markup=markup))
+    else:
+        await target.reply_text(text, reply_markup=markup)
+    return state
 
-    if data in ("card", "cash"):
-        context.user_data.setdefault("_history", []).append(PAYMENT)
-        context.user_data["payment"] = get_text(context.user_data, "card") if data == "card" else get_text(context.user_data, "cash")
+def _is_back(update: Update, ud: dict) -> bool:
+    if update.callback_query:
+        return update.callback_query.data == "back_any"
+    return _message_text(update) == get_text(ud, "back")
 
-        await query.message.reply_text(get_text(context.user_data, "order_button"), reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(context.user_data, "order_button"), callback_data="place_order")]]))
-        return PAYMENT
+async def go_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pop the previous state off `_history` and render it.
+
+    Callers answer the callback query themselves: Telegram rejects a second answer.
+    """
+    hist = context.user_data.get("_history", [])
+    if not hist:
+        return await start(update, context)
+    return await render_screen(update, context, hist.pop())
+
+async def back_any_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    return await go_back(update, context)
+
+def make_state_handler(state: int):
+    screen = SCREENS[state]
+
+    async def handle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.callback_query:
+            await update.callback_query.answer()
+        elif is_home_text(_message_text(update)):
+            return await start(update, context)
+        if _is_back(update, context.user_data):
+            return await go_back(update, context)
+
+        nxt = await screen.parse(update, context)
+        if nxt == STAY:
+            return state
+        if nxt == REDRAW:
+            return await render_screen(update, context, state, edit=True)
+        if nxt is None:
+            return await render_screen(update, context, state)
+        context.user_data.setdefault("_history", []).append(state)
+        return await render_screen(update, context, nxt)
+
+    handle.__name__ = handle.__qualname__ = f"handle_{STATE_NAMES[state].lower()}"
+    return handle
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.clear()
+    context.user_data.setdefault("_history", [])
+
+    photo = product_photo()
+    if photo:
+        remember_product_photo(await update.effective_message.reply_photo(photo=photo))
+    return await render_screen(update, context, LANG)
+
+# ===== Orders =====
+def _area_display(ud: dict) -> str:
+    lang = ud.get("lang", "uz")
+    area_choice = ud.get("area_choice")
+    if area_choice == "city":
+        return get_text_for_lang(lang, "tashkent_city_button").replace("🏙 ", "")
+    if area_choice == "province":
+        return get_text_for_lang(lang, "tashkent_province_button").replace("🏞 ", "")
+    return ""
+
+def build_order_text(ud: dict) -> str:
+    qty = ud.get("quantity", 0)
+    total = PRICE_PER_BOTTLE * qty
+    area_display = _area_display(ud)
+
+    text = (
+        f"📦 Yangi buyurtma\n\n"
+        f"👤 Ism: {ud.get('name')}\n"
+        f"📞 Telefon: {ud.get('phone')}\n"
+        f"🏷 Shaxs turi: {ud.get('person_type')}\n"
+        f"💧 Miqdor: {qty}\n"
+        f"🧾 Jami summa: {total} {CURRENCY}\n"
+        f"📅 Yetkazib berish: {ud.get('delivery_date')}\n"
+        f"💰 To‘lov: {ud.get('payment')}\n"
+    )
+    if ud.get("comment"):
+        text += f"📝 Izoh: {ud.get('comment')}\n"
+    if area_display:
+        text += f"📌 Hudud: {area_display}\n"
+    if ud.get("district"):
+        text += f"🏘 Tuman: {ud.get('district')}\n"
+    if ud.get("address_text"):
+        text += f"🏠 Manzil (matn): {ud.get('address_text')}\n"
+    if ud.get("location"):
+        text += f"🌍 Manzil: https://maps.google.com/?q={ud['location']['lat']},{ud['location']['lon']}\n"
+    delivery = ud.get("delivery")
+    if delivery:
+        if delivery.get("street"):
+            text += f"🛣 Ko'cha (tekshirilgan): {delivery['street']} ({int(delivery['street_score'] * 100)}%)\n"
+        text += f"🚚 Zona {delivery['zone']} · {delivery['distance_km']} km · {delivery['fee']} {CURRENCY}\n"
+    return text
+
+def build_order_row(ud: dict) -> dict:
+    """Flat order record used for CSV digests."""
+    qty = ud.get("quantity", 0)
+    loc = ud.get("location")
+    return {
+        "created_at": datetime.now(TZ).strftime("%Y-%m-%d %H:%M"),
+        "name": ud.get("name") or "",
+        "phone": ud.get("phone") or "",
+        "person_type": ud.get("person_type") or "",
+        "quantity": qty,
+        "total": PRICE_PER_BOTTLE * qty,
+        "delivery_date": ud.get("delivery_date") or "",
+        "payment": ud.get("payment") or "",
+        "comment": ud.get("comment") or "",
+        "area": _area_display(ud),
+        "district": ud.get("district") or "",
+        "address": ud.get("address_text") or "",
+        "location": f"https://maps.google.com/?q={loc['lat']},{loc['lon']}" if loc else "",
+        "street": (ud.get("delivery") or {}).get("street", ""),
+        "zone": (ud.get("delivery") or {}).get("zone", ""),
+        "distance_km": (ud.get("delivery") or {}).get("distance_km", ""),
+        "delivery_fee": (ud.get("delivery") or {}).get("fee", ""),
+    }
 
-    return PAYMENT
+def is_urgent_order(ud: dict) -> bool:
+    if ud.get("quantity", 0) >= URGENT_QUANTITY:
+        return True
+    try:
+        delivery = datetime.strptime(ud.get("delivery_date") or "", "%Y-%m-%d").date()
+    except ValueError:
+        return False
+    return delivery <= datetime.now(TZ).date() + timedelta(days=URGENT_DELIVERY_DAYS)
+
+async def dispatch_order(app, ud: dict):
+    """Route the order to its operations chats, directly or through the digest buffer.
+
+    Direct sends run as independent background tasks, one per chat, so a slow or
+    rate-limited chat neither delays the others nor the customer's confirmation.
+    """
+    text = build_order_text(ud)
+    targets = route_order(ud)
+    if ORDER_DIGEST_MODE == "off" or is_urgent_order(ud) or SHUTTING_DOWN.is_set():
+        for chat_id in dict.fromkeys(targets):
+            outbox_task(app, send_to_target_chat(app.bot, chat_id, text))
+    else:
+        row = build_order_row(ud)
+        for chat_id in dict.fromkeys(targets):
+            await queue_order_for_digest(app, chat_id, text, row)
 
 async def final_place_order_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -606,51 +1269,19 @@ async def final_place_order_handler(update: Update, context: ContextTypes.DEFAUL
     data = query.data
 
     if data == "back_any":
-        return await render_state_from_history(update, context)
+        return await go_back(update, context)
 
     if data == "place_order":
         ud = context.user_data
-        qty = ud.get("quantity", 0)
-        total = PRICE_PER_BOTTLE * qty
-
-        # Area display text
-        lang = ud.get("lang", "uz")
-        area_choice = ud.get("area_choice")
-        if area_choice == "city":
-            area_display = get_text_for_lang(lang, "tashkent_city_button").replace("🏙 ", "")
-        elif area_choice == "province":
-            area_display = get_text_for_lang(lang, "tashkent_province_button").replace("🏞 ", "")
-        else:
-            area_display = ""
-
-        text = (
-            f"📦 Yangi buyurtma\n\n"
-            f"👤 Ism: {ud.get('name')}\n"
-            f"📞 Telefon: {ud.get('phone')}\n"
-            f"🏷 Shaxs turi: {ud.get('person_type')}\n"
-            f"💧 Miqdor: {qty}\n"
-            f"🧾 Jami summa: {total} {CURRENCY}\n"
-            f"📅 Yetkazib berish: {ud.get('delivery_date')}\n"
-            f"💰 To‘lov: {ud.get('payment')}\n"
-        )
-        if ud.get("comment"):
-            text += f"📝 Izoh: {ud.get('comment')}\n"
-        if area_display:
-            text += f"📌 Hudud: {area_display}\n"
-        if ud.get("district"):
-            text += f"🏘 Tuman: {ud.get('district')}\n"
-        if ud.get("address_text"):
-            text += f"🏠 Manzil (matn): {ud.get('address_text')}\n"
-        if ud.get("location"):
-            text += f"🌍 Manzil: https://maps.google.com/?q={ud['location']['lat']},{ud['location']['lon']}\n"
-
-        # send order to target chat with retry-on-timeout/backoff behavior
         try:
-            await context.bot.send_message(chat_id=TARGET_CHAT_ID, text=text)
-        except TimedOut:
-            logger.warning("TimedOut while sending order to target chat - ignored (will not crash).")
+            await dispatch_order(context.application, ud)
         except Exception:
-            logger.exception("Failed to send order to target chat")
+            logger.exception("Failed to dispatch order to target chats")
+
+        try:
+            await save_customer(update.effective_chat.id, ud)
+        except Exception:
+            logger.exception("Failed to save customer (ignored)")
 
         try:
             await query.message.reply_text(get_text(context.user_data, "thanks"))
@@ -673,180 +1304,818 @@ async def final_place_order_handler(update: Update, context: ContextTypes.DEFAUL
 
         return LANG
 
-    return PAYMENT
+    return CONFIRM
 
-async def render_state_from_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    hist = context.user_data.get("_history", [])
-    if not hist:
-        return await start(update, context)
-    prev_state = hist.pop()
-    context.user_data["_history"] = hist
+# compiled once: state -> handler coroutine
+STATE_DISPATCH = {state: make_state_handler(state) for state, screen in SCREENS.items() if screen.parse}
+STATE_DISPATCH[CONFIRM] = final_place_order_handler
 
-    target = update.message if update.message else update.callback_query.message
+def build_state_handlers() -> dict:
+    """ConversationHandler `states` mapping derived from the screen table."""
+    handlers = {}
+    for state, screen in SCREENS.items():
+        callback = STATE_DISPATCH[state]
+        if screen.pattern:
+            handlers[state] = [CallbackQueryHandler(callback, pattern=screen.pattern)]
+        else:
+            handlers[state] = [MessageHandler(screen.input_filter, callback)]
+    return handlers
 
-    if prev_state == LANG:
-        kb = [["🇺🇿 Uzbek", "🇷🇺 Russian", "🇬🇧 English"]]
-        await target.reply_text(TEXTS["uz"]["welcome"], reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
-        return LANG
+def benchmark_screens(rounds: int = 2000) -> dict:
+    """Microseconds per render (prompt + keyboard) for each screen; no network involved."""
+    import timeit
 
-    if prev_state == PERSON_TYPE:
-        buttons = [[b] for b in get_text(context.user_data, "person_buttons")]
-        buttons.append([get_text(context.user_data, "back")])
-        await target.reply_text(get_text(context.user_data, "ask_person"), reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
-        return PERSON_TYPE
-
-    if prev_state == PHONE:
-        contact_button = KeyboardButton(text=get_text(context.user_data, "share_contact"), request_contact=True)
-        await target.reply_text(get_text(context.user_data, "ask_phone"), reply_markup=ReplyKeyboardMarkup([[contact_button], [get_text(context.user_data, "back")]], resize_keyboard=True))
-        return PHONE
-
-    if prev_state == NAME:
-        await target.reply_text(get_text(context.user_data, "ask_name"), reply_markup=ReplyKeyboardRemove())
-        return NAME
-
-    if prev_state == QUANTITY:
-        cnt = context.user_data.get("quantity", 2)
-        markup = build_qty_markup(cnt, context.user_data["lang"])
-        price_caption = build_price_caption(cnt, context.user_data["lang"])
-        if IMAGE_BYTES:
-            bio = io.BytesIO(IMAGE_BYTES)
-            bio.name = "image.jpg"
-            await target.reply_photo(photo=bio, caption=f"{get_text(context.user_data, 'ask_quantity')}\n\n{price_caption}", reply_markup=markup)
-        else:
-            await target.reply_text(f"{get_text(context.user_data, 'ask_quantity')}\n\n{price_caption}", reply_markup=markup)
-        return QUANTITY
+    ud = {"lang": "uz", "quantity": 3, "_history": []}
+    return {
+        STATE_NAMES[state]: timeit.timeit(lambda s=screen: (s.prompt(ud), s.keyboard(ud)), number=rounds) / rounds * 1e6
+        for state, screen in SCREENS.items()
+    }
 
-    if prev_state in (COMMENT, COMMENT_INPUT):
-        # Qaytishda: shahar/viloyat tanlovini qayta ko'rsatamiz
-        lang = context.user_data.get("lang", "uz")
-        buttons = [
-            [get_text_for_lang(lang, "tashkent_city_button")],
-            [get_text_for_lang(lang, "tashkent_province_button")],
-            [get_text_for_lang(lang, "back")],
-        ]
-        await target.reply_text(get_text_for_lang(lang, "ask_city_or_province"),
-                                reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
-        return CITY_OR_PROVINCE
+# ===== Broadcast =====
+class RateLimiter:
+    """Token bucket shared by all concurrent senders: at most `rate` acquisitions per second."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            if self._last is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._tokens = 1.0
+                self._last = loop.time()
+            self._tokens -= 1
+
+_BROADCAST_TASKS = {}  # broadcast id -> asyncio.Task
+
+async def _sleep_unless_shutdown(seconds: float) -> bool:
+    """Sleep for `seconds`; returns True (early) if shutdown starts meanwhile."""
+    try:
+        await asyncio.wait_for(SHUTTING_DOWN.wait(), timeout=seconds)
+        return True
+    except asyncio.TimeoutError:
+        return False
 
-    if prev_state == CITY_OR_PROVINCE:
-        # Qaytishda – izoh bosqichiga qaytish o‘rniga shu tanlovni qayta beramiz
-        lang = context.user_data.get("lang", "uz")
-        buttons = [
-            [get_text_for_lang(lang, "tashkent_city_button")],
-            [get_text_for_lang(lang, "tashkent_province_button")],
-            [get_text_for_lang(lang, "back")],
-        ]
-        await target.reply_text(get_text_for_lang(lang, "ask_city_or_province"),
-                                reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
-        return CITY_OR_PROVINCE
+async def _broadcast_send_one(bot, chat_id: int, row: dict, limiter: RateLimiter, sem: asyncio.Semaphore) -> str:
+    """Send one broadcast message. Returns "sent", "blocked", "failed" or "skipped" (shutting down)."""
+    async with sem:
+        for _ in range(3):
+            await limiter.acquire()
+            if SHUTTING_DOWN.is_set():
+                return "skipped"
+            try:
+                if row["photo_file_id"]:
+                    await bot.send_photo(chat_id=chat_id, photo=row["photo_file_id"], caption=row["text"] or None)
+                else:
+                    await bot.send_message(chat_id=chat_id, text=row["text"])
+                return "sent"
+            except RetryAfter as e:
+                logger.warning("RetryAfter during broadcast, sleeping %s s", e.retry_after)
+                if await _sleep_unless_shutdown(e.retry_after):
+                    return "skipped"
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return "blocked"
+                logger.warning("BadRequest broadcasting to %s: %s", chat_id, e)
+                return "failed"
+            except TimedOut:
+                continue
+            except Exception:
+                logger.exception("Failed to broadcast to %s", chat_id)
+                return "failed"
+        return "failed"
+
+def _broadcast_progress_text(row: dict, eta_seconds=None) -> str:
+    done = row["sent"] + row["failed"] + row["removed"]
+    text = (
+        f"📣 Xabar tarqatish #{row['id']}\n"
+        f"Jarayon: {done}/{row['total']}\n"
+        f"✅ Yuborildi: {row['sent']}\n"
+        f"❌ Xato: {row['failed']}\n"
+        f"🚫 Bloklagan (o'chirildi): {row['removed']}\n"
+    )
+    if row["status"] == "done":
+        text += "Tugadi ✅"
+    elif eta_seconds is not None:
+        text += f"Qolgan vaqt: ~{int(eta_seconds // 60)} daq {int(eta_seconds % 60)} s"
+    return text
+
+async def _update_broadcast_progress(bot, row: dict, eta_seconds=None):
+    if not row["admin_chat_id"] or not row["progress_message_id"]:
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=row["admin_chat_id"],
+            message_id=row["progress_message_id"],
+            text=_broadcast_progress_text(row, eta_seconds),
+        )
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            logger.warning("Failed to update broadcast progress: %s", e)
+    except Exception:
+        logger.exception("Failed to update broadcast progress (ignored)")
 
-    if prev_state == DISTRICT:
-        # Agar city tanlangan bo'lsa — tumanlarni qayta ko'rsatamiz, aks holda manzilga o'tamiz
-        lang = context.user_data.get("lang", "uz")
-        if context.user_data.get("area_choice") == "city":
-            rows = districts_keyboard_for_lang(lang)
-            await target.reply_text(get_text_for_lang(lang, "ask_district"), reply_markup=ReplyKeyboardMarkup(rows, resize_keyboard=True))
-            return DISTRICT
-        else:
-            await target.reply_text(get_text_for_lang(lang, "ask_address_text"), reply_markup=ReplyKeyboardRemove())
-            return ADDRESS_TEXT
+_BROADCAST_COLUMNS = (
+    "id", "text", "photo_file_id", "admin_chat_id", "progress_message_id",
+    "last_chat_id", "total", "sent", "failed", "removed", "status",
+)
 
-    if prev_state == ADDRESS_TEXT:
-        await target.reply_text(get_text(context.user_data, "ask_address_text"), reply_markup=ReplyKeyboardRemove())
-        return ADDRESS_TEXT
+async def _load_broadcast(broadcast_id: int) -> dict:
+    r = await db_run(f"SELECT {', '.join(_BROADCAST_COLUMNS)} FROM broadcasts WHERE id = ?", (broadcast_id,), fetch="one")
+    return dict(zip(_BROADCAST_COLUMNS, r)) if r else None
+
+async def run_broadcast(bot, broadcast_id: int):
+    """Send a broadcast to every customer, resuming from the last checkpointed chat id."""
+    row = await _load_broadcast(broadcast_id)
+    if not row or row["status"] != "running":
+        return
+
+    remaining = (await db_run("SELECT COUNT(*) FROM customers WHERE chat_id > ?", (row["last_chat_id"],), fetch="one"))[0]
+    row["total"] = row["sent"] + row["failed"] + row["removed"] + remaining
+    await db_run("UPDATE broadcasts SET total = ? WHERE id = ?", (row["total"], broadcast_id))
+
+    limiter = RateLimiter(BROADCAST_RATE, burst=BROADCAST_CONCURRENCY)
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    done_at_start = row["sent"] + row["failed"] + row["removed"]
+    last_progress = 0.0
+
+    async for page in iter_customer_pages(row["last_chat_id"], BROADCAST_PAGE_SIZE):
+        if SHUTTING_DOWN.is_set():
+            logger.info("Broadcast #%s paused for shutdown at chat %s; it resumes on next start", broadcast_id, row["last_chat_id"])
+            return
+        results = await asyncio.gather(*(_broadcast_send_one(bot, cid, row, limiter, sem) for cid in page))
+        # on shutdown the rest of the page is skipped: checkpoint only the prefix that is fully done
+        # (a restart re-sends at most BROADCAST_CONCURRENCY chats sent after the first skipped one)
+        paused = "skipped" in results
+        if paused:
+            done = results.index("skipped")
+            page, results = page[:done], results[:done]
+            if not page:
+                logger.info("Broadcast #%s paused for shutdown at chat %s; it resumes on next start", broadcast_id, row["last_chat_id"])
+                return
+
+        blocked = [cid for cid, res in zip(page, results) if res == "blocked"]
+        if blocked:
+            await db_run(f"DELETE FROM customers WHERE chat_id IN ({','.join('?' * len(blocked))})", tuple(blocked))
+        row["sent"] += results.count("sent")
+        row["failed"] += results.count("failed")
+        row["removed"] += len(blocked)
+        row["last_chat_id"] = page[-1]
+
+        # checkpoint after every page: a restart re-sends at most one page
+        await db_run(
+            "UPDATE broadcasts SET last_chat_id = ?, sent = ?, failed = ?, removed = ? WHERE id = ?",
+            (row["last_chat_id"], row["sent"], row["failed"], row["removed"], broadcast_id),
+        )
+        if paused:
+            logger.info("Broadcast #%s paused for shutdown at chat %s; it resumes on next start", broadcast_id, row["last_chat_id"])
+            return
+
+        now = loop.time()
+        if now - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+            last_progress = now
+            done = row["sent"] + row["failed"] + row["removed"]
+            speed = (done - done_at_start) / max(now - started, 1e-6)
+            eta = (row["total"] - done) / speed if speed > 0 else None
+            await _update_broadcast_progress(bot, row, eta)
+
+    row["status"] = "done"
+    await db_run("UPDATE broadcasts SET status = 'done' WHERE id = ?", (broadcast_id,))
+    await _update_broadcast_progress(bot, row)
+    logger.info("Broadcast #%s finished: %s sent, %s failed, %s removed", broadcast_id, row["sent"], row["failed"], row["removed"])
+
+def start_broadcast_task(app, broadcast_id: int):
+    if broadcast_id in _BROADCAST_TASKS and not _BROADCAST_TASKS[broadcast_id].done():
+        return
+    task = app.create_task(run_broadcast(app.bot, broadcast_id))
+    _BROADCAST_TASKS[broadcast_id] = task
+    task.add_done_callback(lambda _t: _BROADCAST_TASKS.pop(broadcast_id, None))
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast <text> — or reply to a photo with /broadcast [caption] to send that photo."""
+    msg = update.message
+    raw = msg.text or ""
+    # strip the command entity itself; the announcement may start on the next line
+    command = next((e for e in msg.entities or () if e.type == "bot_command" and e.offset == 0), None)
+    text = raw[command.length:].strip() if command else (raw.split(maxsplit=1)[1:] or [""])[0].strip()
+    photo_file_id = None
+    reply = msg.reply_to_message
+    if reply:
+        if reply.photo:
+            # reuse Telegram's file_id: no re-upload per recipient
+            photo_file_id = reply.photo[-1].file_id
+        if not text:
+            text = (reply.caption or reply.text or "").strip()
+
+    if not text and not photo_file_id:
+        await msg.reply_text("Foydalanish: /broadcast <matn> yoki rasmga javob sifatida /broadcast [izoh]")
+        return
+
+    # Telegram would reject an over-long message for every single recipient
+    limit = TELEGRAM_MAX_CAPTION if photo_file_id else TELEGRAM_MAX_MESSAGE
+    if len(text) > limit:
+        await msg.reply_text(f"Matn juda uzun: {len(text)} belgi (ruxsat etilgan: {limit}).")
+        return
+
+    if any(not t.done() for t in _BROADCAST_TASKS.values()):
+        await msg.reply_text("Boshqa xabar tarqatish hali tugamagan.")
+        return
+
+    progress = await msg.reply_text("📣 Xabar tarqatish boshlanmoqda...")
+    broadcast_id = await db_run(
+        "INSERT INTO broadcasts (text, photo_file_id, admin_chat_id, progress_message_id, created_at) VALUES (?, ?, ?, ?, ?)",
+        (text, photo_file_id, progress.chat_id, progress.message_id, datetime.now(TZ).isoformat()),
+    )
+    start_broadcast_task(context.application, broadcast_id)
+
+async def resume_broadcasts(app):
+    """Restart broadcasts that were interrupted (e.g. by a redeploy) from their checkpoint."""
+    rows = await db_run("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id", fetch="all")
+    for (broadcast_id,) in rows:
+        logger.info("Resuming interrupted broadcast #%s", broadcast_id)
+        start_broadcast_task(app, broadcast_id)
+
+# ===== Health / readiness =====
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that counts in-flight requests and remembers the last successful getUpdates."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_size = kwargs.get("connection_pool_size", 1)
+        self.in_flight = 0
+        self.last_get_updates_ok = None
+
+    async def do_request(self, url, method, *args, **kwargs):
+        self.in_flight += 1
+        try:
+            result = await super().do_request(url, method, *args, **kwargs)
+        finally:
+            self.in_flight -= 1
+        # do_request returns (status, payload) even for 409/429/5xx; PTB raises only afterwards
+        if url.endswith("/getUpdates") and 200 <= result[0] <= 299:
+            self.last_get_updates_ok = time.time()
+        return result
+
+_HEALTH = {
+    "started_at": time.time(),
+    "ready": False,
+    "last_update_at": None,
+    "loop_lag": collections.deque(maxlen=120),  # seconds, one sample per LOOP_LAG_INTERVAL
+    "requests": {},  # name -> InstrumentedRequest
+}
+_HEALTH_TASKS = []
+LOOP_LAG_INTERVAL = 0.5
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        before = loop.time()
+        _HEALTH["loop_tick"] = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        _HEALTH["loop_lag"].append(max(0.0, loop.time() - before - LOOP_LAG_INTERVAL))
+
+def conversation_counts(app) -> dict:
+    """Active conversations per state, from the `_state` marker render_screen keeps in user_data."""
+    cutoff = time.time() - CONVERSATION_ACTIVE_WINDOW
+    counts = collections.Counter(
+        STATE_NAMES[ud["_state"]]
+        for ud in app.user_data.values()
+        if ud.get("_state") is not None and ud.get("_seen", 0) >= cutoff
+    )
+    return dict(counts)
+
+def health_report(app) -> dict:
+    now = time.time()
+    getter = _HEALTH["requests"].get("get_updates")
+    general = _HEALTH["requests"].get("general")
+    last_poll = getattr(getter, "last_get_updates_ok", None)
+    # a successful getUpdates or a handled update (e.g. webhook) both prove the bot is receiving
+    last_seen = max(filter(None, (last_poll, _HEALTH["last_update_at"])), default=None)
+    since_ok = now - (last_seen or _HEALTH["started_at"])
+    lags = _HEALTH["loop_lag"]
+
+    live = since_ok <= HEALTH_STALL_SECONDS and (not lags or lags[-1] <= HEALTH_MAX_LOOP_LAG)
+    ready = live and _HEALTH["ready"] and not SHUTTING_DOWN.is_set() and bool(app.updater and app.updater.running)
+    return {
+        "live": live,
+        "ready": ready,
+        "shutting_down": SHUTTING_DOWN.is_set(),
+        "uptime_s": round(now - _HEALTH["started_at"], 1),
+        "seconds_since_last_get_updates": round(now - last_poll, 1) if last_poll else None,
+        "seconds_since_last_update": round(now - _HEALTH["last_update_at"], 1) if _HEALTH["last_update_at"] else None,
+        "outbox_depth": len(_OUTBOX) + sum(len(v) for v in _DIGEST_BUFFER.values()),
+        "update_queue_size": app.update_queue.qsize(),
+        "loop_lag_ms": {
+            "last": round(lags[-1] * 1000, 1) if lags else None,
+            "max_1m": round(max(lags) * 1000, 1) if lags else None,
+        },
+        "http_pool": {
+            "in_flight": general.in_flight if general else None,
+            "size": general.pool_size if general else None,
+            "saturation": round(general.in_flight / general.pool_size, 2) if general else None,
+        },
+        "conversations": conversation_counts(app),
+    }
 
-    if prev_state == AWAIT_GEOLOCATION:
-        loc_button = KeyboardButton("📍 Send Location", request_location=True)
-        await target.reply_text(get_text(context.user_data, "ask_location"), reply_markup=ReplyKeyboardMarkup([[loc_button], [get_text(context.user_data, "back")]], resize_keyboard=True))
-        return AWAIT_GEOLOCATION
-
-    if prev_state == DELIVERY_DATE:
-        # use TZ-aware date here as well
-        today = datetime.now(TZ).date()
-        options = []
-        d = today + timedelta(days=1)
-        while len(options) < 5:
-            if d.weekday() == 6:
-                d += timedelta(days=1)
+async def _handle_health_request(app, reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass  # headers are not needed
+        parts = request_line.decode("latin-1").split()
+        path = parts[1].split("?")[0] if len(parts) > 1 else "/"
+
+        report = health_report(app)
+        if path in ("/healthz", "/livez"):
+            ok = report["live"]
+        elif path == "/readyz":
+            ok = report["ready"]
+        elif path in ("/", "/status"):
+            ok = True
+        else:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            return
+        body = json.dumps(report).encode()
+        status = b"200 OK" if ok else b"503 Service Unavailable"
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\nContent-Type: application/json\r\n"
+            + f"Content-Length: {len(body)}\r\n".encode() + b"Connection: close\r\n\r\n" + body
+        )
+    except Exception:
+        logger.debug("Health request failed", exc_info=True)
+    finally:
+        try:
+            await writer.drain()
+            writer.close()
+        except Exception:
+            pass
+
+async def start_health_server(app):
+    _HEALTH_TASKS.append(asyncio.create_task(monitor_loop_lag()))
+    if not HEALTH_PORT:
+        return
+    server = await asyncio.start_server(
+        functools.partial(_handle_health_request, app), host=HEALTH_HOST, port=HEALTH_PORT
+    )
+    _HEALTH["server"] = server
+    logger.info("Health endpoint on http://%s:%s/healthz (/readyz, /status)", HEALTH_HOST, HEALTH_PORT)
+
+async def stop_health_server():
+    for task in _HEALTH_TASKS:
+        task.cancel()
+    _HEALTH_TASKS.clear()
+    server = _HEALTH.pop("server", None)
+    if server:
+        server.close()
+        await server.wait_closed()
+
+# ===== Profiler (opt-in) =====
+class StackSampler(threading.Thread):
+    """Samples the event-loop thread's stack from a side thread.
+
+    Samples are aggregated into folded stacks for the periodic profile, kept briefly so a
+    slow handler can be attributed, and used to catch the loop being blocked while it is
+    still blocked (the frame on top is the blocking call).
+    """
+
+    IDLE_FRAME = "selectors.py:select"  # loop waiting for I/O, i.e. nothing running
+
+    def __init__(self, target_thread_id: int):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.target_thread_id = target_thread_id
+        self.interval = 1.0 / PROFILE_SAMPLE_HZ
+        self.folded = collections.Counter()
+        self.recent = collections.deque(maxlen=int(PROFILE_SAMPLE_HZ * 120))  # (monotonic time, folded stack)
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._reported_stall = None
+        self._last_export = time.monotonic()
+
+    @staticmethod
+    def fold(frame, max_depth: int = 64) -> str:
+        names = []
+        while frame is not None and len(names) < max_depth:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is None:
                 continue
-            options.append(d.strftime("%Y-%m-%d"))
-            d += timedelta(days=1)
-        buttons = [[InlineKeyboardButton(x, callback_data=f"date_{x}")] for x in options]
-        buttons.append([InlineKeyboardButton(get_text(context.user_data, "back"), callback_data="back_any")])
-        await target.reply_text(get_text(context.user_data, "ask_delivery"), reply_markup=InlineKeyboardMarkup(buttons))
-        return DELIVERY_DATE
-
-    if prev_state == PAYMENT:
-        buttons = [
-            [InlineKeyboardButton(get_text(context.user_data, "card"), callback_data="card"), InlineKeyboardButton(get_text(context.user_data, "cash"), callback_data="cash")],
-            [InlineKeyboardButton(get_text(context.user_data, "back"), callback_data="back_any")],
-        ]
-        await target.reply_text(get_text(context.user_data, "ask_payment"), reply_markup=InlineKeyboardMarkup(buttons))
-        return PAYMENT
+            now = time.monotonic()
+            stack = self.fold(frame)
+            del frame
+            with self._lock:
+                self.folded[stack] += 1
+                self.recent.append((now, stack))
+            self._check_stall(now, stack)
+            if now - self._last_export >= PROFILE_EXPORT_INTERVAL:
+                self._last_export = now
+                self.export()
+
+    def _check_stall(self, now: float, stack: str):
+        tick = _HEALTH.get("loop_tick")
+        if tick is None:
+            return
+        blocked_for = now - tick - LOOP_LAG_INTERVAL
+        if blocked_for * 1000 >= PROFILE_SLOW_MS and self._reported_stall != tick:
+            self._reported_stall = tick
+            logger.warning("Event loop blocked for %.0f ms, currently in: %s", blocked_for * 1000, stack.replace(";", " > "))
+
+    def stacks_between(self, start: float, end: float):
+        with self._lock:
+            return [stack for t, stack in self.recent if start <= t <= end]
+
+    def export(self):
+        with self._lock:
+            lines = [f"{stack} {count}\n" for stack, count in self.folded.items()]
+        tmp = PROFILE_PATH + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            os.replace(tmp, PROFILE_PATH)
+        except Exception:
+            logger.exception("Failed to write profile to %s (ignored)", PROFILE_PATH)
+
+    def stop(self):
+        self._stop_event.set()
+
+_SAMPLER = None
+
+def describe_slow_window(start: float, end: float) -> str:
+    """Summarise what the loop did during a slow update: blocked (with hottest stack) or waiting on I/O."""
+    if _SAMPLER is None:
+        return "no samples"
+    stacks = _SAMPLER.stacks_between(start, end)
+    busy = [s for s in stacks if not s.endswith(StackSampler.IDLE_FRAME)]
+    if not stacks:
+        return "no samples (raise PROFILE_SAMPLE_HZ)"
+    if not busy:
+        return f"loop idle in all {len(stacks)} samples: waiting on I/O (Telegram / network latency)"
+    hottest, hits = collections.Counter(busy).most_common(1)[0]
+    return f"loop busy in {len(busy)}/{len(stacks)} samples, hottest stack ({hits}x): {hottest.replace(';', ' > ')}"
+
+def timed_callback(callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        state = context.user_data.get("_state") if isinstance(context.user_data, dict) else None
+        start = time.monotonic()
+        try:
+            return await callback(update, context)
+        finally:
+            end = time.monotonic()
+            elapsed_ms = (end - start) * 1000
+            if elapsed_ms >= PROFILE_SLOW_MS:
+                query = getattr(update, "callback_query", None)
+                logger.warning(
+                    "Slow update %s: %s took %.0f ms (state=%s, callback_data=%r); %s",
+                    getattr(update, "update_id", None),
+                    getattr(callback, "__name__", repr(callback)),
+                    elapsed_ms,
+                    STATE_NAMES[state] if isinstance(state, int) and 0 <= state < len(STATE_NAMES) else state,
+                    query.data if query else None,
+                    describe_slow_window(start, end),
+                )
+    return wrapper
+
+def _iter_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from _iter_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                yield from _iter_handlers(state_handlers)
+            yield from _iter_handlers(handler.fallbacks)
+        else:
+            yield handler
+
+def instrument_handlers(app):
+    """Wrap the callback of every registered handler (including conversation states) with timing."""
+    count = 0
+    for group_handlers in app.handlers.values():
+        for handler in _iter_handlers(group_handlers):
+            handler.callback = timed_callback(handler.callback)
+            count += 1
+    logger.info("Profiler: timing %s handlers, slow threshold %.0f ms, %.0f Hz sampling -> %s", count, PROFILE_SLOW_MS, PROFILE_SAMPLE_HZ, PROFILE_PATH)
+
+def start_profiler():
+    global _SAMPLER
+    if PROFILE_SAMPLE_HZ <= 0:
+        logger.info("Profiler: PROFILE_SAMPLE_HZ=%s, stack sampling disabled", PROFILE_SAMPLE_HZ)
+        return
+    _SAMPLER = StackSampler(threading.main_thread().ident)
+    _SAMPLER.start()
+
+def stop_profiler():
+    if _SAMPLER is not None:
+        _SAMPLER.stop()
+        _SAMPLER.export()
+
+# ===== Lifecycle =====
+_STARTUP_MARKS = {}  # phase -> ms since the first line of this module
+
+def startup_mark(phase: str):
+    _STARTUP_MARKS.setdefault(phase, (time.perf_counter() - _T_IMPORT_START) * 1000)
+
+def report_startup(app=None):
+    """Log start-up phase latencies up to the latest mark; with --measure-startup, the report for
+    the first handled update (or STARTUP_MEASURE_TIMEOUT without one) stops the bot."""
+    if not STARTUP_PROFILE:
+        return
+    phases = ", ".join(f"{k} {v:.0f} ms" for k, v in _STARTUP_MARKS.items())
+    total = max(_STARTUP_MARKS.values(), default=0)
+    if total > STARTUP_BUDGET_MS:
+        logger.warning("Start-up over budget (%.0f ms > %.0f ms): %s", total, STARTUP_BUDGET_MS, phases)
+    else:
+        logger.info("Start-up within budget (%.0f ms <= %.0f ms): %s", total, STARTUP_BUDGET_MS, phases)
+    if app is None or "--measure-startup" not in sys.argv:
+        return
+    if "first_update" in _STARTUP_MARKS:
+        _request_shutdown(app)
+    else:
+        asyncio.get_running_loop().call_later(STARTUP_MEASURE_TIMEOUT, _request_shutdown, app)
+
+_LAST_UPDATE_ID = None  # last update fully processed by the handlers
+
+async def track_processed_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs in the last handler group, i.e. after the update was handled."""
+    global _LAST_UPDATE_ID
+    _HEALTH["last_update_at"] = time.time()
+    if "first_update" not in _STARTUP_MARKS:
+        startup_mark("first_update")
+        report_startup(context.application)
+    if _LAST_UPDATE_ID is None or update.update_id > _LAST_UPDATE_ID:
+        _LAST_UPDATE_ID = update.update_id
+
+def _load_offset():
+    try:
+        with open(OFFSET_PATH, encoding="utf-8") as f:
+            return int(json.load(f)["offset"])
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.exception("Could not read %s (ignored)", OFFSET_PATH)
+        return None
+
+def _save_offset(offset: int):
+    tmp = OFFSET_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"offset": offset, "saved_at": datetime.now(TZ).isoformat()}, f)
+    os.replace(tmp, OFFSET_PATH)
+
+async def _confirm_offset(bot, offset: int):
+    """getUpdates with an offset marks every earlier update as delivered on Telegram's side."""
+    await bot.get_updates(offset=offset, limit=1, timeout=0)
 
-    return await start(update, context)
+_SAVED_OFFSET = None
+
+async def persist_offset(app):
+    """Save the offset after the last processed update and confirm it with Telegram."""
+    global _SAVED_OFFSET
+    if _LAST_UPDATE_ID is None or _LAST_UPDATE_ID + 1 == _SAVED_OFFSET:
+        return
+    offset = _LAST_UPDATE_ID + 1
+    try:
+        _save_offset(offset)
+        _SAVED_OFFSET = offset
+    except Exception:
+        logger.exception("Failed to save update offset (ignored)")
+    try:
+        await _confirm_offset(app.bot, offset)
+    except Exception:
+        logger.exception("Failed to confirm update offset with Telegram (saved copy will be used)")
+
+def _shutdown_time_left() -> float:
+    if _SHUTDOWN_DEADLINE is None:
+        return SHUTDOWN_TIMEOUT
+    return max(_SHUTDOWN_DEADLINE - asyncio.get_running_loop().time(), 0)
+
+async def drain_outbox(app, timeout: float):
+    """Flush digest buffers and wait for pending target-chat sends, cancelling what is left after `timeout`."""
+    flush_all_digests(app)
+    pending = list(_OUTBOX)
+    if not pending:
+        return
+    done, not_done = await asyncio.wait(pending, timeout=timeout)
+    for task in not_done:
+        task.cancel()
+    if not_done:
+        logger.warning("Shutdown deadline hit: %s pending target-chat sends cancelled", len(not_done))
+
+async def graceful_shutdown(app):
+    """SIGTERM/SIGINT: stop fetching, drain handlers and sends within SHUTDOWN_TIMEOUT, then stop the loop.
+
+    Stopping the loop hands over to run_polling, which stops the Application (processing any
+    update already fetched), flushes persistence and then calls post_stop/post_shutdown.
+    """
+    global _SHUTDOWN_DEADLINE
+    if SHUTTING_DOWN.is_set():
+        return
+    SHUTTING_DOWN.set()
+    loop = asyncio.get_running_loop()
+    deadline = _SHUTDOWN_DEADLINE = loop.time() + SHUTDOWN_TIMEOUT
+    logger.info("Shutdown requested: no longer fetching updates, draining work (max %.0f s)", SHUTDOWN_TIMEOUT)
+    for task in list(_STARTUP_TASKS):
+        task.cancel()
+
+    try:
+        if app.updater and app.updater.running:
+            await app.updater.stop()
+        try:
+            await asyncio.wait_for(app.update_queue.join(), timeout=max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            logger.warning("Shutdown deadline hit with %s updates still queued", app.update_queue.qsize())
+        # first, so a kill during the drain below cannot make the next instance re-handle updates
+        await persist_offset(app)
+        await drain_outbox(app, max(deadline - loop.time(), 0))
+        # broadcasts stop at their next send and checkpoint; Application.stop() would otherwise
+        # wait for them without any deadline
+        broadcasts = [t for t in _BROADCAST_TASKS.values() if not t.done()]
+        if broadcasts:
+            _, not_done = await asyncio.wait(broadcasts, timeout=max(deadline - loop.time(), 0))
+            for task in not_done:
+                task.cancel()
+            if not_done:
+                logger.warning("Shutdown deadline hit: %s broadcasts cancelled before their checkpoint", len(not_done))
+    except Exception:
+        logger.exception("Error during graceful shutdown")
+    finally:
+        loop.stop()
+
+_SHUTDOWN_TASKS = set()  # keep a strong reference so the task is not garbage collected
+_SHUTDOWN_DEADLINE = None  # loop.time() by which graceful_shutdown must be done
+
+def _request_shutdown(app):
+    task = asyncio.ensure_future(graceful_shutdown(app))
+    _SHUTDOWN_TASKS.add(task)
+    task.add_done_callback(_SHUTDOWN_TASKS.discard)
+
+_STARTUP_TASKS = set()  # background start-up work, cancelled by graceful_shutdown if still pending
+
+async def after_start(app):
+    """Start-up work that spawns Application tasks: waits until the Application is running,
+    because PTB only tracks (and Application.stop() only awaits) tasks created while running."""
+    while not app.running:
+        if SHUTTING_DOWN.is_set():
+            return
+        await asyncio.sleep(0.05)
+    try:
+        await restore_digests(app)
+    except Exception:
+        logger.exception("Failed to restore digest orders (ignored)")
+    try:
+        await resume_broadcasts(app)
+    except Exception:
+        logger.exception("Failed to resume broadcasts (ignored)")
+
+async def post_init(app):
+    loop = asyncio.get_running_loop()
+    try:
+        await start_health_server(app)
+    except Exception:
+        logger.exception("Failed to start health endpoint (ignored)")
+    if PROFILE:
+        try:
+            start_profiler()
+        except Exception:
+            logger.exception("Failed to start profiler (ignored)")
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, _request_shutdown, app)
+        except (NotImplementedError, RuntimeError):
+            logger.warning("Signal handlers not supported; graceful shutdown disabled for %s", sig)
+
+    # confirm updates the previous instance already processed, so they are never handled twice
+    offset = _load_offset()
+    if offset is not None:
+        try:
+            await _confirm_offset(app.bot, offset)
+            logger.info("Resuming after update offset %s", offset)
+        except Exception:
+            logger.exception("Failed to confirm saved update offset %s (ignored)", offset)
+
+    # not awaited: polling should start without waiting for the database
+    task = asyncio.create_task(after_start(app))
+    _STARTUP_TASKS.add(task)
+    task.add_done_callback(_STARTUP_TASKS.discard)
+    _HEALTH["ready"] = True
+    startup_mark("ready")
+    report_startup(app)
+
+async def post_stop(app):
+    # every fetched update has been processed by now (Application.stop drains the queue); a no-op
+    # unless Application.stop handled updates graceful_shutdown had not waited for
+    await persist_offset(app)
+    await drain_outbox(app, _shutdown_time_left())
+    logger.info("Shutdown complete (last update %s)", _LAST_UPDATE_ID)
+
+async def post_shutdown(app):
+    global _DB
+    await stop_health_server()
+    stop_profiler()
+    with _DB_LOCK:
+        if _DB is not None:
+            _DB.close()
+            _DB = None
 
 # ===== MAIN =====
 def main():
+    if "--bench-screens" in sys.argv:
+        for name, usec in benchmark_screens().items():
+            print(f"{name:<20} {usec:8.1f} us/render")
+        return
+
+    startup_mark("main")
+    # compile the routing table now so a bad config is reported at start-up, not on the first order
+    get_order_routes()
+    os.makedirs(DATA_DIR, exist_ok=True)
+
     if not BOT_TOKEN or BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
         raise SystemExit("Please set BOT_TOKEN environment variable.")
 
-    # Configure Request (if available) to make the bot faster and more robust
+    # Configure requests to make the bot faster and more robust; they are also instrumented
+    # for the health endpoint (pool saturation, last successful getUpdates)
     request = None
-    if Request:
-        try:
-            request = Request(
-                con_pool_size=8,
-                connect_timeout=5.0,
-                read_timeout=20.0,
-                pool_timeout=5.0,
-            )
-        except Exception:
-            logger.exception("Request() creation failed, falling back to default ApplicationBuilder request")
+    try:
+        request = InstrumentedRequest(
+            connection_pool_size=HTTP_POOL_SIZE,
+            connect_timeout=5.0,
+            read_timeout=20.0,
+            pool_timeout=5.0,
+        )
+        get_updates_request = InstrumentedRequest(connection_pool_size=1, connect_timeout=5.0, read_timeout=20.0)
+        _HEALTH["requests"] = {"general": request, "get_updates": get_updates_request}
+    except Exception:
+        logger.exception("Request() creation failed, falling back to default ApplicationBuilder request")
+        request = None
+
+    def builder():
+        return (
+            ApplicationBuilder()
+            .token(BOT_TOKEN)
+            .persistence(PicklePersistence(filepath=STATE_PATH))
+            .post_init(post_init)
+            .post_stop(post_stop)
+            .post_shutdown(post_shutdown)
+        )
 
     # Build application: with custom request if available
     try:
         if request:
-            app = ApplicationBuilder().token(BOT_TOKEN).request(request).build()
+            app = builder().request(request).get_updates_request(get_updates_request).build()
         else:
-            app = ApplicationBuilder().token(BOT_TOKEN).build()
+            app = builder().build()
     except Exception:
         logger.exception("ApplicationBuilder build failed; retrying without custom request")
-        app = ApplicationBuilder().token(BOT_TOKEN).build()
+        _HEALTH["requests"] = {}
+        app = builder().build()
 
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
-        states={
-            LANG: [MessageHandler(filters.TEXT & ~filters.COMMAND, lang_chosen)],
-            PERSON_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, person_chosen)],
-            PHONE: [MessageHandler(filters.CONTACT | (filters.TEXT & ~filters.COMMAND), received_phone)],
-            NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_name)],
-            QUANTITY: [CallbackQueryHandler(quantity_handler, pattern=r"^(incr|decr|count|continue_qty)$")],
-            COMMENT: [CallbackQueryHandler(comment_choice_handler, pattern=r"^(comment_yes|comment_no|back_any)$")],
-            COMMENT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, comment_input_handler)],
-            CITY_OR_PROVINCE: [MessageHandler(filters.TEXT & ~filters.COMMAND, choose_city_or_province)],
-            DISTRICT: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_district)],
-            ADDRESS_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, received_address_text)],
-            AWAIT_GEOLOCATION: [MessageHandler(filters.LOCATION | (filters.TEXT & ~filters.COMMAND), received_geo_location)],
-            DELIVERY_DATE: [CallbackQueryHandler(delivery_handler, pattern=r"^date_.*|back_any$")],
-            PAYMENT: [CallbackQueryHandler(payment_handler, pattern=r"^(card|cash|back_any)$")],
-        },
+        states=build_state_handlers(),
         fallbacks=[CommandHandler("start", start)],
         allow_reentry=True,
+        name="order_conversation",
+        persistent=True,
     )
 
     app.add_handler(conv)
     app.add_handler(CallbackQueryHandler(final_place_order_handler, pattern=r"^place_order$"))
-    app.add_handler(CallbackQueryHandler(lambda u, c: render_state_from_history(u, c), pattern=r"^back_any$"))
+    app.add_handler(CallbackQueryHandler(back_any_handler, pattern=r"^back_any$"))
+    app.add_handler(CommandHandler("broadcast", broadcast_command, filters=filters.User(user_id=ADMIN_IDS)))
+    app.add_handler(TypeHandler(Update, track_processed_update), group=100)
+    if PROFILE:
+        instrument_handlers(app)
+    startup_mark("build")
 
     logger.info("Bot started")
     try:
-        app.run_polling()
+        # SIGTERM/SIGINT are handled by graceful_shutdown (installed in post_init)
+        app.run_polling(stop_signals=None)
     except KeyboardInterrupt:
         logger.info("Stopping bot (KeyboardInterrupt)")
     except Exception:
+        # exit non-zero so the orchestrator restarts us instead of leaving an idle process
         logger.exception("Unexpected error in run_polling")
+        raise SystemExit(1)
+
 
+startup_mark("import")
 
 if __name__ == "__main__":
     main()